@@ -0,0 +1,149 @@
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from touchscreen import touchscreenHMM
+from touchscreen_helpers import simulation_io
+from touchscreen_helpers.simulation_evaluator import touchscreenEvaluator
+
+# How many files each worker is handed at a time
+FILES_PER_TASK = 4
+
+# The touchscreenHMM of each screen size this process has built, reused
+# between files
+models: Dict[Tuple[int, int], touchscreenHMM] = {}
+
+
+def simulation_files(pattern: str) -> List[str]:
+    """
+    Returns the saved simulations in a directory, or matching a glob, sorted.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*")
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+
+def model_for(width: int, height: int) -> touchscreenHMM:
+    model = models.get((width, height))
+    if model is None:
+        model = models[(width, height)] = touchscreenHMM(width, height)
+    return model
+
+
+def rubric(evaluator: touchscreenEvaluator, totals) -> Optional[dict]:
+    """
+    summarize, or None when the rubric is undefined: when every noisy touch
+    landed on the finger, there is nothing for the HMM to improve on.
+    """
+    try:
+        return evaluator.summarize(*totals)
+    except ZeroDivisionError:
+        return None
+
+
+def evaluate_file(path: str) -> dict:
+    """
+    Replays one saved simulation through this process's touchscreenHMM of its
+    screen size, starting from the prior.
+
+    Output:
+    - The file, its frame count, the seconds it took, the summed scores and
+      missed frame counts, and its own rubric (None when undefined, see
+      rubric); or the file and an error
+    """
+    start = time.perf_counter()
+    try:
+        replay = simulation_io.touchscreenReplay.from_file(path)
+        if replay.frames == 0:
+            return {"file": path, "error": "no frames"}
+        model = model_for(replay.width, replay.height)
+        model.hmm.reset()
+        evaluator = touchscreenEvaluator()
+        totals = evaluator.replay_totals(model, replay)
+    except Exception as error:
+        # One bad file (unreadable, or with touches off the screen) must not stop the corpus
+        return {"file": path, "error": f"{type(error).__name__}: {error}"}
+    return {
+        "file": path,
+        "frames": replay.frames,
+        "seconds": time.perf_counter() - start,
+        "totals": [float(total) for total in totals],
+        "missed_frames": evaluator.missed,
+        "noisy_frames": evaluator.noisy_missed,
+        "score": rubric(evaluator, totals),
+    }
+
+
+def evaluate_corpus(pattern: str, workers: Optional[int] = None) -> dict:
+    """
+    Evaluates every saved simulation in a directory or matching a glob, spread
+    across a process pool. Each worker builds one touchscreenHMM per screen
+    size and reuses it between files; models are trained (or loaded) here
+    first, so the workers only load the cached tables.
+
+    Input:
+    - pattern: A directory, or a glob of saved simulations in either format
+    - workers: The number of processes, os.cpu_count() by default; 1
+               evaluates in this process
+
+    Output:
+    - A report: the rubric over every frame of every file, throughput
+      statistics, the per-file results and any files that failed
+    """
+    paths = simulation_files(pattern)
+    workers = workers or os.cpu_count() or 1
+    sizes = set()
+    for path in paths:
+        try:
+            sizes.add(simulation_io.read_simulation_header(path)[:2])
+        except (OSError, ValueError):
+            pass
+    for width, height in sorted(sizes):
+        model_for(width, height)
+
+    # Throughput covers the replays only, not training the models above
+    start = time.perf_counter()
+    if workers == 1:
+        results = [evaluate_file(path) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(evaluate_file, paths, chunksize=FILES_PER_TASK))
+    elapsed = time.perf_counter() - start
+
+    scored = [result for result in results if "error" not in result]
+    failed = [result for result in results if "error" in result]
+    report = {
+        "files": len(scored),
+        "failed": failed,
+        "workers": workers,
+        "seconds": elapsed,
+    }
+    if not scored:
+        return report
+
+    # Summarize every frame together, as if the files were one long run
+    evaluator = touchscreenEvaluator()
+    evaluator.missed = sum(result["missed_frames"] for result in scored)
+    evaluator.noisy_missed = sum(result["noisy_frames"] for result in scored)
+    totals = np.sum([result["totals"] for result in scored], axis=0)
+    frames = sum(result["frames"] for result in scored)
+    file_seconds = np.array([result["seconds"] for result in scored])
+    report.update(
+        {
+            "score": rubric(evaluator, totals),
+            "frames": frames,
+            "frames_per_s": frames / elapsed,
+            "files_per_s": len(scored) / elapsed,
+            "file_seconds": {
+                "p50": float(np.percentile(file_seconds, 50)),
+                "p90": float(np.percentile(file_seconds, 90)),
+                "max": float(np.max(file_seconds)),
+            },
+            "per_file": [{key: result[key] for key in ("file", "frames", "seconds", "score")} for result in scored],
+        }
+    )
+    return report
@@ -0,0 +1,165 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from smoothing import forward_backward_segments
+from touchscreen import HMM, touchscreenHMM
+from touchscreen_helpers.model_estimation import touchscreenCounts
+
+# Bounds the (frames x transitions) products built while counting expected
+# transitions, so the E-step's memory does not grow with the screen size
+MAX_PAIR_PRODUCTS = 1 << 22
+
+
+def expected_counts(
+    prior: np.ndarray,
+    transition: sparse.spmatrix,
+    sensor: sparse.spmatrix,
+    width: int,
+    height: int,
+    sequences: Sequence[np.ndarray],
+) -> Tuple[touchscreenCounts, float]:
+    """
+    The E-step of Baum-Welch for a batch of noisy touch sequences: how often
+    each state is expected to be occupied, each transition taken and each
+    touch seen from each state, given the current tables.
+
+    Only transitions and sensor readings the current tables allow can get
+    counts, so the counts keep the sparsity of the tables.
+
+    Input:
+    - prior, transition, sensor: The current tables, as in touchscreenHMM
+    - width, height:             The size of the screen
+    - sequences:                 (T x 2) integer arrays of noisy (x, y) touches
+
+    Output:
+    - The expected counts, including the posterior of the state before each
+      sequence's first touch (counts.initial), and the log-likelihood of the sequences
+    """
+    hmm = HMM.from_tables(prior, transition, sensor, width, height)
+    counts = touchscreenCounts(width, height, dtype=float)
+    transition = sparse.coo_matrix(transition)
+    rows, cols, values = transition.row, transition.col, transition.data
+    chunk = max(1, MAX_PAIR_PRODUCTS // max(len(values), 1))
+    shape = (hmm.num_states, hmm.num_states)
+    log_likelihood = 0.0
+
+    for observations in sequences:
+        observations = np.asarray(observations)
+        flat = observations[:, 0] * height + observations[:, 1]
+        for start, checkpoint, alphas, betas, likelihoods, scales in forward_backward_segments(hmm, observations):
+            # Occupancy and sensor readings from the smoothed posteriors
+            gammas = alphas * betas
+            totals = np.sum(gammas, axis=1)
+            totals[totals == 0] = 1
+            gammas /= totals[:, None]
+            counts.occupancy += np.sum(gammas, axis=0)
+            frames, states = np.nonzero(gammas)
+            counts.sensor += sparse.csr_matrix(
+                (gammas[frames, states], (states, flat[start + frames])), shape=shape
+            )
+
+            # Transitions: xi_t(i, j) is proportional to alpha_{t-1}(i) T(i, j) e_t(j) beta_t(j),
+            # and sums to one over (i, j); c_t * sum(alpha_t * beta_t) is that sum. Frames
+            # where the track restarted used no transition and are skipped.
+            # The prior is the state before the first touch, which the first
+            # transition leaves from; its posterior is the EM update of the prior
+            if start == 0 and scales[0] > 0:
+                counts.initial += checkpoint * (hmm.transition @ (likelihoods[0] * betas[0])) / (scales[0] * totals[0])
+
+            previous = np.vstack((checkpoint, alphas[:-1]))
+            kept = scales > 0
+            log_likelihood += np.sum(np.log(scales[kept]))
+            arriving = likelihoods[kept] * betas[kept] / (scales[kept] * totals[kept])[:, None]
+            previous = previous[kept]
+            pair_sums = np.zeros(len(values))
+            for i in range(0, len(previous), chunk):
+                pair_sums += np.einsum(
+                    "tk,tk->k", previous[i:i + chunk][:, rows], arriving[i:i + chunk][:, cols]
+                )
+            counts.transitions += sparse.csr_matrix((pair_sums * values, (rows, cols)), shape=shape)
+    return counts, log_likelihood
+
+
+# The tables each worker process has attached to, by shared memory name
+attached = {}
+
+
+def shared_expected_counts(name: str, sequences: Sequence[np.ndarray]) -> Tuple[touchscreenCounts, float]:
+    """
+    expected_counts on tables published in shared memory, attaching to them
+    once per worker process.
+    """
+    model = attached.get(name)
+    if model is None:
+        for stale in attached.values():
+            stale.close()
+        attached.clear()
+        model = attached[name] = touchscreenHMM.attach(name)
+    return expected_counts(model.prior, model.transition_table, model.sensor_table, model.width, model.height, sequences)
+
+
+def baum_welch(
+    model,
+    sequences: Sequence[np.ndarray],
+    iterations: int = 10,
+    workers: Optional[int] = None,
+    tolerance: float = 1e-4,
+    shards_per_worker: int = 4,
+) -> List[float]:
+    """
+    Re-estimates a touchscreenHMM's tables from noisy-only touch sequences
+    with EM, starting from its current (simulator-trained) tables. The
+    sequences are sharded across a process pool for the E-step, and the
+    expected counts of the shards are merged before normalizing. Each
+    iteration's tables are published to the workers in shared memory.
+
+    Input:
+    - model:             A trained touchscreenHMM, updated in place
+    - sequences:         (T x 2) integer arrays of noisy (x, y) touches
+    - iterations:        The most EM iterations to run
+    - workers:           The number of processes, os.cpu_count() by default;
+                         1 runs the E-step in this process
+    - tolerance:         Stops once the log-likelihood per frame improves by less
+    - shards_per_worker: How many shards each worker gets per iteration
+
+    Output:
+    - The log-likelihood of the sequences before each iteration's update
+    """
+    workers = workers or os.cpu_count() or 1
+    frames = max(sum(len(observations) for observations in sequences), 1)
+    shard_count = min(len(sequences), workers * shards_per_worker) or 1
+    shards = [sequences[i::shard_count] for i in range(shard_count)]
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    history = []
+    try:
+        for _ in range(iterations):
+            if pool is None:
+                tables = (model.prior, model.transition_table, model.sensor_table, model.width, model.height)
+                results = [expected_counts(*tables, shard) for shard in shards]
+            else:
+                with model.publish_models() as shared:
+                    futures = [pool.submit(shared_expected_counts, shared.name, shard) for shard in shards]
+                    results = [future.result() for future in futures]
+
+            counts = touchscreenCounts(model.width, model.height, dtype=float)
+            log_likelihood = 0.0
+            for shard_counts, shard_log_likelihood in results:
+                counts.merge(shard_counts)
+                log_likelihood += shard_log_likelihood
+            history.append(log_likelihood)
+
+            _, model.transition_table, model.sensor_table = counts.tables()
+            if np.sum(counts.initial) > 0:
+                model.prior = counts.initial / np.sum(counts.initial)
+            model.build_hmm()
+            if len(history) > 1 and (history[-1] - history[-2]) / frames < tolerance:
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return history
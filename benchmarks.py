@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+import touchscreen
+from hmm import HMM
+from touchscreen import touchscreenHMM
+from touchscreen_helpers import model_store, simulation_io
+from touchscreen_helpers.batch_simulator import touchscreenBatchSimulator
+from touchscreen_helpers.simulation_evaluator import touchscreenEvaluator
+from touchscreen_helpers.simulator import touchscreenSimulator
+
+# A benchmark fails when its median latency grows by more than this fraction
+# over the baseline
+REGRESSION_TOLERANCE = 0.25
+# Where the baseline is read from, and written to with --update_baseline.
+# Timings only compare on the same machine, so none is committed: save one
+# with --update_baseline before the first comparison
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks_baseline.json")
+PERCENTILES = (50, 90, 99)
+
+
+def measure(function: Callable[[], None], runs: int, operations: int = 1, setup: Optional[Callable[[], None]] = None) -> dict:
+    """
+    Times function over several runs, calling setup (untimed) before each.
+
+    Input:
+    - function:   What to time
+    - runs:       How many times to time it
+    - operations: How many operations one call performs, for the throughput
+    - setup:      Run before every call, outside the timing
+
+    Output:
+    - The percentile and mean latencies of one operation in microseconds, and
+      the throughput in operations per second
+    """
+    times = np.empty(runs)
+    for i in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times[i] = time.perf_counter() - start
+    per_operation = times / operations * 1e6
+    stats = {f"p{p}_us": float(np.percentile(per_operation, p)) for p in PERCENTILES}
+    stats["mean_us"] = float(np.mean(per_operation))
+    stats["ops_per_s"] = float(operations * runs / max(np.sum(times), 1e-12))
+    stats["runs"] = runs
+    return stats
+
+
+def random_hmm(num_states: int, num_observations: int, rng) -> HMM:
+    transition = rng.random((num_states, num_states))
+    transition /= np.sum(transition, axis=1, keepdims=True)
+    sensor = rng.random((num_observations, num_states))
+    sensor /= np.sum(sensor, axis=0, keepdims=True)
+    return HMM(lambda o, s: sensor[o, s], lambda s, t: transition[s, t], num_states)
+
+
+def bench_hmm(args) -> Dict[str, dict]:
+    rng = np.random.default_rng(0)
+    results = {}
+    for num_states in (10, 100) if args.quick else (10, 100, 1000):
+        start = time.perf_counter()
+        model = random_hmm(num_states, 8, rng)
+        results[f"hmm.construct[{num_states}]"] = {"seconds": time.perf_counter() - start}
+        observations = iter(rng.integers(8, size=10 ** 6).tolist())
+        results[f"hmm.tell[{num_states}]"] = measure(lambda: model.tell(next(observations)), args.runs)
+        for horizon in (1, 100, 10000):
+            results[f"hmm.ask[{num_states},t={horizon}]"] = measure(
+                lambda: model.ask(model.time + horizon), args.runs, setup=lambda: model.tell(next(observations))
+            )
+    return results
+
+
+def bench_touchscreen(args) -> Dict[str, dict]:
+    results = {}
+    previous_frames = touchscreen.TRAINING_FRAMES
+    touchscreen.TRAINING_FRAMES = args.training_frames
+    # Train into a scratch cache, so the first construction of each size always trains
+    previous_cache = os.environ.get("TOUCHSCREEN_MODEL_CACHE")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ["TOUCHSCREEN_MODEL_CACHE"] = cache_dir
+        try:
+            for size in (20,) if args.quick else (20, 50, 100):
+                start = time.perf_counter()
+                touchscreenHMM(size, size)
+                results[f"touchscreen.train[{size}x{size}]"] = {"seconds": time.perf_counter() - start}
+                results[f"touchscreen.load[{size}x{size}]"] = measure(lambda: touchscreenHMM(size, size), max(args.runs // 100, 3))
+
+                model = touchscreenHMM(size, size)
+                simulator = touchscreenSimulator(size, size, args.frames)
+                simulator.run_simulation()
+                positions = simulation_io.simulation_positions(simulator)
+                frames = [simulator.convert_coordinate_to_screen(x, y) for x, y in positions[: args.runs, :2].tolist()]
+                tuples = [(x, y) for x, y in positions[: args.runs, :2].tolist()]
+                frame_iter, tuple_iter = iter(frames), iter(tuples)
+                results[f"touchscreen.filter_frame[{size}x{size}]"] = measure(
+                    lambda: model.filter_noisy_data(next(frame_iter)), len(frames)
+                )
+                results[f"touchscreen.filter_position[{size}x{size}]"] = measure(
+                    lambda: model.filter_noisy_data(next(tuple_iter)), len(tuples)
+                )
+        finally:
+            touchscreen.TRAINING_FRAMES = previous_frames
+            if previous_cache is None:
+                del os.environ["TOUCHSCREEN_MODEL_CACHE"]
+            else:
+                os.environ["TOUCHSCREEN_MODEL_CACHE"] = previous_cache
+    return results
+
+
+def bench_simulator(args) -> Dict[str, dict]:
+    simulator = touchscreenSimulator(20, 20, args.frames)
+    results = {"simulator.run": measure(simulator.run_simulation, 3, args.frames)}
+    simulator.run_simulation()
+    results["simulator.get_frame"] = measure(
+        lambda: simulator.get_frame(actual_position=True), min(args.runs, args.frames)
+    )
+    for batch in (1, 256):
+        batch_simulator = touchscreenBatchSimulator(20, 20, max(args.frames // batch, 1), batch, seed=0)
+        results[f"simulator.numpy_batch[{batch}]"] = measure(batch_simulator.run_simulation, 3, args.frames)
+    return results
+
+
+def bench_io(args) -> Dict[str, dict]:
+    simulator = touchscreenSimulator(20, 20, args.frames)
+    simulator.run_simulation()
+    positions = simulation_io.simulation_positions(simulator)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for binary in (True, False):
+            name = "binary" if binary else "text"
+            path = os.path.join(directory, f"simulation.{name}")
+            results[f"io.save_simulation[{name}]"] = measure(
+                lambda: simulation_io.save_simulation(path, 20, 20, positions, binary), 10, len(positions)
+            )
+            results[f"io.load_simulation[{name}]"] = measure(
+                lambda: np.asarray(simulation_io.load_simulation(path)[2]).sum(), 10, len(positions)
+            )
+
+        rng = np.random.default_rng(0)
+        arrays = {"prior": rng.random(40000), "table": rng.random(10 ** 6)}
+        path = os.path.join(directory, "model.tables")
+        results["io.save_tables"] = measure(lambda: model_store.save_tables(path, arrays, {}), 10)
+        results["io.load_tables"] = measure(lambda: model_store.load_tables(path), 10)
+    return results
+
+
+def bench_evaluator(args) -> Dict[str, dict]:
+    rng = np.random.default_rng(0)
+    frames = min(args.frames, 4096)
+    evaluator = touchscreenEvaluator()
+    student_frames = rng.random((frames, 20, 20))
+    student_frames /= np.sum(student_frames, axis=(1, 2), keepdims=True)
+    noisy_locs = rng.integers(20, size=(frames, 2))
+    actual_locs = rng.integers(20, size=(frames, 2))
+    actual_frame = np.zeros((20, 20))
+    actual_frame[tuple(actual_locs[0])] = 1
+    return {
+        "evaluator.calc_score": measure(lambda: evaluator.calc_score(actual_frame, student_frames[0]), args.runs),
+        "evaluator.calc_distribution_score": measure(
+            lambda: evaluator.calc_distribution_score(actual_frame, actual_frame, student_frames[0]), args.runs
+        ),
+        "evaluator.score_run": measure(lambda: evaluator.score_run(noisy_locs, actual_locs, student_frames), 5, frames),
+    }
+
+
+BENCHMARKS = {
+    "hmm": bench_hmm,
+    "touchscreen": bench_touchscreen,
+    "simulator": bench_simulator,
+    "io": bench_io,
+    "evaluator": bench_evaluator,
+}
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float):
+    """
+    Returns the benchmarks whose median latency grew by more than tolerance
+    over the baseline, as (name, baseline, current) tuples. One-off
+    measurements (a "seconds" entry, such as training) are single samples,
+    too noisy to gate on, so they are only reported.
+    """
+    regressions = []
+    for name, stats in results.items():
+        previous = baseline.get(name, {}).get("p50_us")
+        if previous and "p50_us" in stats and stats["p50_us"] > previous * (1 + tolerance):
+            regressions.append((name, previous, stats["p50_us"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the HMM and touchscreen hot paths. Save a baseline on this machine with "
+        "--update_baseline first; later runs fail if a median latency regresses against it."
+    )
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="the benchmark groups to run")
+    parser.add_argument("--quick", action="store_true", help="only run the smaller sizes")
+    parser.add_argument("--runs", type=int, default=1000, help="the timed runs per benchmark")
+    parser.add_argument("--frames", type=int, default=10000, help="the number of simulated frames to use")
+    parser.add_argument(
+        "--training_frames", type=int, default=20000, help="the frames touchscreen models are trained on"
+    )
+    parser.add_argument("--output", type=str, default="bench_output.json", help="where to write the results")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE, help="the baseline to compare against")
+    parser.add_argument(
+        "--update_baseline", action="store_true", help="save the results as the new baseline instead of comparing"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=REGRESSION_TOLERANCE, help="the allowed slowdown over the baseline"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for group in args.only or BENCHMARKS:
+        print(f"Running {group} benchmarks.")
+        results.update(BENCHMARKS[group](args))
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "benchmarks": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    for name, stats in sorted(results.items()):
+        if "p50_us" in stats:
+            print(f"{name:50} p50 {stats['p50_us']:12.1f} us   p99 {stats['p99_us']:12.1f} us   {stats['ops_per_s']:14.1f} ops/s")
+        else:
+            print(f"{name:50} {stats['seconds']:12.3f} s")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}.")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["benchmarks"]
+        regressions = compare(results, baseline, args.tolerance)
+        for name, previous, current in regressions:
+            print(f"REGRESSION {name}: {previous:.1f} -> {current:.1f} ({current / previous - 1:+.0%})")
+        if regressions:
+            sys.exit(f"{len(regressions)} benchmarks regressed by more than {args.tolerance:.0%}")
+        print("No regressions against the baseline.")
+    else:
+        # A missing baseline must not pass silently, or regressions would never fail the run
+        sys.exit(f"No baseline at {args.baseline}; run with --update_baseline to save one.")
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+import numpy as np
+
+# The default number of observations whose likelihood vectors an EmissionCache keeps
+EMISSION_CACHE_SIZE = 4096
+
+
+class EmissionCache:
+    """
+    Caches the vector of P(observation | state) over every state for the most
+    recently used observations, so a sensor model is called for each state
+    only when an observation is new (or was evicted), and memory stays bounded
+    for large or open observation alphabets: an evicted observation leaves
+    nothing behind.
+    """
+
+    def __init__(self, compute: Callable[[Hashable], np.ndarray], capacity: int = EMISSION_CACHE_SIZE):
+        """
+        Inputs:
+        - compute:  Builds the likelihood vector of an observation on a miss
+        - capacity: The most vectors kept at once
+        """
+        self.compute = compute
+        self.capacity = max(1, capacity)
+        self.vectors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, observation) -> np.ndarray:
+        """
+        Returns the likelihood vector of an observation, computing it on a miss.
+        The vector is shared; callers must not modify it.
+        """
+        likelihoods = self.vectors.get(observation)
+        if likelihoods is not None:
+            self.hits += 1
+            self.vectors.move_to_end(observation)
+            return likelihoods
+
+        self.misses += 1
+        likelihoods = self.compute(observation)
+        self.vectors[observation] = likelihoods
+        if len(self.vectors) > self.capacity:
+            self.vectors.popitem(last=False)
+            self.evictions += 1
+        return likelihoods
+
+    def clear(self):
+        self.vectors.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "cached": len(self.vectors),
+            "capacity": self.capacity,
+        }
@@ -2,6 +2,14 @@ from typing import Callable, List
 
 import numpy as np
 
+from emission_cache import EmissionCache
+from viterbi import Viterbi
+
+# How close (absolute difference) the rows of a transition matrix power must be
+# to count as the stationary distribution
+MIXING_TOLERANCE = 1e-12
+
+
 # Implement your HMM for Part 1 here!
 
 
@@ -42,6 +50,46 @@ class HMM:
         self.time = 0
         self.num_states = num_states
 
+        # Compile the callables once: transition_matrix[s][s'] = P(s' | s), and
+        # emissions[observation][s] = P(observation | s), filled in the first
+        # time each observation is seen since the alphabet is not known upfront.
+        self.transition_matrix = np.array(
+            [
+                [transition_model(current_state, future_state) for future_state in range(num_states)]
+                for current_state in range(num_states)
+            ],
+            dtype=float,
+        )
+        self.emission_cache = EmissionCache(self.compute_emission)
+
+        # transition_powers[i] is transition_matrix^(2^i), rescaled so that long
+        # chains of squaring cannot overflow. predictions memoizes ask by horizon
+        # and is cleared by tell. Once a power has identical (normalized) rows,
+        # the chain has mixed and every longer horizon is the stationary distribution.
+        self.transition_powers = [self.transition_matrix]
+        self.predictions = {}
+        self.mixing_power = None
+        self.stationary = None
+
+    def compute_emission(self, observation) -> np.ndarray:
+        return np.array(
+            [self.sensor_model(observation, state) for state in range(self.num_states)],
+            dtype=float,
+        )
+
+    def emission(self, observation) -> np.ndarray:
+        """
+        Returns the vector of P(observation | state) over every state, calling
+        the sensor model only when the observation is not in the emission cache.
+
+        Input:
+        - observation: The observation to look up, a string
+
+        Output:
+        - A NumPy array of length num_states
+        """
+        return self.emission_cache.lookup(observation)
+
     def tell(self, observation: str):
         """
         Takes in an observation and records it.
@@ -54,28 +102,31 @@ class HMM:
         Output:
         - None
         """
-        future_probabilities = np.zeros((self.num_states)) #num_state number of zeroes
-
-     #   for fs in range (0, self.num_states):
-     #     for cs in range(0, )
+        # Predict with the transition matrix, then weight by the sensor model
+        future_probabilities = (self.probabilities @ self.transition_matrix) * self.emission(observation)
 
-        
-
-        for future_state in range(0, self.num_states): #From 0 to num_states
-          for current_state in range(0, self.num_states): #from 0 to num_states
-            #In each future_state, it equals to the curren_state * the transition model value
-            future_probabilities[future_state] += self.probabilities[current_state] * self.transition_model(current_state, future_state)
-            # if future_state == 1:
-            #   print(f"curr state {current_state}")
-            #   print(f"prob current")
-            #   print(f"transition {self.transition_model(current_state, future_state)}")
-
-          #In each future state, times the value by the sensor model value
-          future_probabilities[future_state] *= self.sensor_model(observation, future_state)
-        
         #Derive alpha value by dividing by the total sum of the future probabilities s.t. the values equal to 1
         self.probabilities = future_probabilities / np.sum(future_probabilities)
         self.time += 1
+        self.predictions = {}
+
+    def transition_power(self, exponent: int) -> np.ndarray:
+        """
+        Returns (a rescaled) transition_matrix^(2^exponent), squaring the
+        largest cached power as many times as needed.
+        """
+        while len(self.transition_powers) <= exponent:
+            last = self.transition_powers[-1]
+            square = last @ last
+            square /= np.max(square)
+            self.transition_powers.append(square)
+
+            rows = square[np.sum(square, axis=1) > 0]
+            rows = rows / np.sum(rows, axis=1, keepdims=True)
+            if self.mixing_power is None and len(rows) and np.allclose(rows, rows[0], rtol=0, atol=MIXING_TOLERANCE):
+                self.mixing_power = len(self.transition_powers) - 1
+                self.stationary = rows[0]
+        return self.transition_powers[exponent]
 
     def ask(self, time: int) -> List[float]:
         """
@@ -90,27 +141,42 @@ class HMM:
         Output:
         - a probability distribution over the hidden state for the given timestep, a list of numbers
         """
+        horizon = time - self.time
+        if horizon <= 0:
+            return self.probabilities
+        if horizon in self.predictions:
+            return self.predictions[horizon].copy()
+
+        # Exponentiation by squaring: apply transition_matrix^(2^i) for every bit i
+        # of the horizon, stopping early if a power that fits has already mixed.
         future_probabilities = self.probabilities
-        # From inputted time to the last time
-        for remaining_time in range(self.time, time):
-          current_probabilities = future_probabilities
-          future_probabilities = np.zeros((self.num_states))
-          # print(f"Time: {remaining_time}")
-
-          
-          # Same as tell
-          for future_state in range(0, self.num_states):
-            for current_state in range(0, self.num_states):
-              future_probabilities[future_state] += current_probabilities[current_state] * self.transition_model(current_state, future_state)
-              #print(f"future probs for {future_state}: {future_probabilities[future_state]}")
-              #if future_state == 1:
-              
-                # print(f"curr state: {current_state}")
-                # print(f"prob current: {self.probabilities[current_state]}")
-                # print(f"transition: {self.transition_model(current_state, future_state)}")
-          future_probabilities /= np.sum(future_probabilities)
-        
-        return future_probabilities
+        exponent = 0
+        while horizon >> exponent:
+            power = self.transition_power(exponent)
+            if self.mixing_power is not None and horizon >> self.mixing_power:
+                future_probabilities = self.stationary.copy()
+                break
+            if (horizon >> exponent) & 1:
+                future_probabilities = future_probabilities @ power
+                future_probabilities /= np.sum(future_probabilities)
+            exponent += 1
+
+        self.predictions[horizon] = future_probabilities
+        return future_probabilities.copy()
+
+    def viterbi(self, max_lag: int = None) -> Viterbi:
+        """
+        Returns a Viterbi decoder over this HMM's models, starting from the
+        current distribution, for finding the most likely sequence of states
+        behind a sequence of observations.
+
+        Input:
+        - max_lag: Bounds how many states the decoder leaves undecided, see Viterbi
+
+        Output:
+        - A Viterbi decoder; its decode method takes a list of observations
+        """
+        return Viterbi(self.transition_matrix, self.emission, self.probabilities, max_lag, self.emission_cache.capacity)
 
 
 #if __name__ == "__main__":        
@@ -0,0 +1,225 @@
+import functools
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import hmm
+import touchscreen
+from touchscreen_helpers.simulation_evaluator import touchscreenEvaluator
+
+# The methods timed by enable(), as stages named "<class>.<method>"
+STAGES = {
+    "hmm.HMM": (hmm.HMM, ["__init__", "emission", "compute_emission", "tell", "ask", "transition_power"]),
+    "touchscreen.HMM": (touchscreen.HMM, ["emission", "compute_emission", "predict", "tell", "tell_pruned"]),
+    "touchscreenHMM": (
+        touchscreen.touchscreenHMM,
+        ["__init__", "load_models", "generate_models", "arr_to_pos", "filter_noisy_data"],
+    ),
+    "touchscreenEvaluator": (
+        touchscreenEvaluator,
+        [
+            "calc_score",
+            "calc_consistency_score",
+            "calc_distribution_score",
+            "calc_scores",
+            "calc_distribution_scores",
+            "score_run",
+            "evaluate_touchscreen_hmm",
+        ],
+    ),
+}
+# Each stage keeps its latest durations, this many at most, for the percentiles
+SAMPLE_LIMIT = 10000
+
+
+class StageStats:
+    """
+    The calls, time and (optionally) memory recorded for one stage.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.total_ns = 0
+        self.samples = np.zeros(SAMPLE_LIMIT, dtype=np.int64)
+        # Only calls made while tracing allocations count towards the memory stats
+        self.traced_calls = 0
+        self.allocated_bytes = 0
+        self.peak_bytes = 0
+
+    def add(self, elapsed_ns: int, allocated: Optional[int] = None, peak: int = 0):
+        self.samples[self.calls % SAMPLE_LIMIT] = elapsed_ns
+        self.calls += 1
+        self.total_ns += elapsed_ns
+        if allocated is not None:
+            self.traced_calls += 1
+            self.allocated_bytes += allocated
+            self.peak_bytes = max(self.peak_bytes, peak)
+
+    def summary(self) -> dict:
+        samples = self.samples[: min(self.calls, SAMPLE_LIMIT)] / 1000
+        summary = {"calls": self.calls, "total_s": self.total_ns / 1e9}
+        if self.calls:
+            summary["mean_us"] = self.total_ns / self.calls / 1000
+            summary.update({f"p{p}_us": float(np.percentile(samples, p)) for p in (50, 90, 99)})
+        if self.traced_calls:
+            summary["allocated_bytes_per_call"] = self.allocated_bytes / self.traced_calls
+            summary["peak_bytes"] = self.peak_bytes
+        return summary
+
+
+# Everything below is module state: instrumentation is process-wide
+stages: Dict[str, StageStats] = {}
+originals = {}
+tracing_allocations = False
+# Whether enable() started tracemalloc, and so disable() should stop it
+started_tracemalloc = False
+# The peaks of the calls in progress, innermost last, see timed
+peak_stack: List[int] = []
+stats_lock = threading.Lock()
+dump_thread = None
+dump_stop = threading.Event()
+
+
+def timed(name: str, method):
+    """
+    Wraps a method so every call is recorded under the stage name.
+    """
+    stage = stages.setdefault(name, StageStats())
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if not tracing_allocations:
+            start = time.perf_counter_ns()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter_ns() - start
+                with stats_lock:
+                    stage.add(elapsed)
+
+        # tracemalloc has one peak, so each call hands the peak so far to the call
+        # around it, resets it, and hands its own peak back when it returns.
+        # This assumes one thread is being traced.
+        before, peak = tracemalloc.get_traced_memory()
+        if peak_stack:
+            peak_stack[-1] = max(peak_stack[-1], peak)
+        tracemalloc.reset_peak()
+        peak_stack.append(before)
+        start = time.perf_counter_ns()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            after, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, peak_stack.pop())
+            if peak_stack:
+                peak_stack[-1] = max(peak_stack[-1], peak)
+            with stats_lock:
+                stage.add(elapsed, after - before, peak - before)
+
+    return wrapper
+
+
+def enable(allocations: bool = False):
+    """
+    Starts recording every stage in STAGES. Until this is called the classes
+    are untouched, so instrumentation costs nothing while disabled.
+
+    Input:
+    - allocations: Whether to also trace memory with tracemalloc, recording
+                   the bytes each call leaves allocated and its peak. This
+                   slows every allocation down considerably.
+    """
+    global tracing_allocations, started_tracemalloc
+    disable()
+    tracing_allocations = allocations
+    if allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started_tracemalloc = True
+    for prefix, (cls, methods) in STAGES.items():
+        for method_name in methods:
+            method = cls.__dict__.get(method_name)
+            if method is None:
+                continue
+            originals[(cls, method_name)] = method
+            setattr(cls, method_name, timed(f"{prefix}.{method_name}", method))
+
+
+def disable():
+    """
+    Puts the original methods back. Recorded stats are kept until reset().
+    """
+    global tracing_allocations, started_tracemalloc
+    for (cls, method_name), method in originals.items():
+        setattr(cls, method_name, method)
+    originals.clear()
+    if started_tracemalloc:
+        tracemalloc.stop()
+    tracing_allocations = False
+    started_tracemalloc = False
+
+
+def enabled() -> bool:
+    return bool(originals)
+
+
+def reset():
+    """
+    Forgets every recorded call.
+    """
+    with stats_lock:
+        for stage in stages.values():
+            stage.__init__()
+
+
+def stats() -> Dict[str, dict]:
+    """
+    Returns a summary of every stage called so far: its call count, total
+    seconds, mean and percentile latencies in microseconds and, when tracing
+    allocations, the bytes allocated per call and the peak.
+    """
+    with stats_lock:
+        return {name: stage.summary() for name, stage in sorted(stages.items()) if stage.calls}
+
+
+def dump(stream=None):
+    """
+    Writes the stats as one line of JSON, with a timestamp.
+    """
+    stream = stream or sys.stderr
+    stream.write(json.dumps({"time": time.time(), "stages": stats()}) + "\n")
+    stream.flush()
+
+
+def start_dump(path: Optional[str] = None, interval: float = 10.0):
+    """
+    Dumps the stats every interval seconds from a daemon thread, appending
+    them to path (or writing to stderr) until stop_dump.
+    """
+    global dump_thread
+    stop_dump()
+    dump_stop.clear()
+
+    def run():
+        while not dump_stop.wait(interval):
+            if path is None:
+                dump()
+            else:
+                with open(path, "a") as f:
+                    dump(f)
+
+    dump_thread = threading.Thread(target=run, name="instrumentation-dump", daemon=True)
+    dump_thread.start()
+
+
+def stop_dump():
+    global dump_thread
+    if dump_thread is not None:
+        dump_stop.set()
+        dump_thread.join()
+        dump_thread = None
@@ -0,0 +1,118 @@
+import numpy as np
+from scipy import ndimage, signal, sparse
+
+# Kernels with at least this many cells are convolved with FFTs; smaller ones
+# are cheaper to apply directly
+FFT_KERNEL_CELLS = 121
+
+
+def displacement_kernel(prior, transition, width: int, height: int) -> np.ndarray:
+    """
+    Collapses a learned transition table into a translation-invariant motion
+    kernel: how likely each displacement of the finger is in one frame, over
+    every state, weighted by how often the state is occupied.
+
+    Input:
+    - prior:         How often each state is occupied, as in touchscreenHMM.prior
+    - transition:    A sparse matrix with transition[s][s'] = P(s' | s)
+    - width, height: The size of the screen
+
+    Output:
+    - A (2m + 1 x 2m + 1) array summing to 1, m being the furthest step taken;
+      kernel[m + dx][m + dy] is the probability of moving by (dx, dy)
+    """
+    transition = sparse.coo_matrix(transition)
+    weights = np.asarray(prior)[transition.row] * transition.data
+    dx = transition.col // height - transition.row // height
+    dy = transition.col % height - transition.row % height
+    reach = int(max(np.max(np.abs(dx), initial=0), np.max(np.abs(dy), initial=0)))
+    kernel = np.zeros((2 * reach + 1, 2 * reach + 1))
+    np.add.at(kernel, (dx + reach, dy + reach), weights)
+    total = np.sum(kernel)
+    if total == 0:
+        kernel[reach, reach] = 1
+        total = 1
+    return kernel / total
+
+
+class MotionKernel:
+    """
+    A translation-invariant motion model: from any cell, the finger moves by a
+    displacement drawn from one kernel. Displacements that would leave the
+    screen are dropped and the rest renormalized, so each cell's transitions
+    still sum to one near the edges.
+
+    Predicting is then a 2D convolution of the belief grid, costing
+    O(HW log HW) with FFTs instead of a product with a (HW x HW) table.
+    """
+
+    def __init__(self, kernel: np.ndarray, width: int, height: int, fft: bool = None):
+        """
+        Input:
+        - kernel:        An odd-sized 2D array, see displacement_kernel
+        - width, height: The size of the screen
+        - fft:           Whether to convolve with FFTs, by default when the kernel
+                         has at least FFT_KERNEL_CELLS cells
+        """
+        self.kernel = np.asarray(kernel, dtype=float)
+        self.width = width
+        self.height = height
+        self.num_states = width * height
+        self.fft = self.kernel.size >= FFT_KERNEL_CELLS if fft is None else fft
+
+        # The kernel mass that stays on the screen from each cell
+        self.on_screen = self.correlate(np.ones((width, height)))
+        self.on_screen[self.on_screen == 0] = 1
+
+    @classmethod
+    def from_tables(cls, prior, transition, width: int, height: int, fft: bool = None) -> "MotionKernel":
+        return cls(displacement_kernel(prior, transition, width, height), width, height, fft)
+
+    def convolve(self, grids: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+        """
+        Convolves the last two axes of grids with kernel, keeping their size.
+        """
+        kernel = kernel.reshape((1,) * (grids.ndim - 2) + kernel.shape)
+        if self.fft:
+            # FFTs leave rounding noise around zero, which must not become negative probability
+            return np.maximum(signal.fftconvolve(grids, kernel, mode="same", axes=(-2, -1)), 0)
+        return ndimage.convolve(grids, kernel, mode="constant")
+
+    def correlate(self, grids: np.ndarray) -> np.ndarray:
+        return self.convolve(grids, self.kernel[::-1, ::-1])
+
+    def predict(self, probabilities: np.ndarray) -> np.ndarray:
+        """
+        Returns the distribution one frame later, summing over the current cells
+        for every future cell.
+
+        Input:
+        - probabilities: An array of length num_states, or (K x num_states) for K streams
+
+        Output:
+        - An array of the same shape
+        """
+        grids = probabilities.reshape(probabilities.shape[:-1] + (self.width, self.height))
+        return self.convolve(grids / self.on_screen, self.kernel).reshape(probabilities.shape)
+
+    def matrix(self) -> sparse.csr_matrix:
+        """
+        The equivalent transition table, transition[s][s'] = P(s' | s).
+        """
+        reach_x, reach_y = self.kernel.shape[0] // 2, self.kernel.shape[1] // 2
+        xs, ys = np.divmod(np.arange(self.num_states), self.height)
+        rows, cols, values = [], [], []
+        for dx in range(-reach_x, reach_x + 1):
+            for dy in range(-reach_y, reach_y + 1):
+                nx, ny = xs + dx, ys + dy
+                kept = (nx >= 0) & (nx < self.width) & (ny >= 0) & (ny < self.height)
+                rows.append(np.flatnonzero(kept))
+                cols.append(nx[kept] * self.height + ny[kept])
+                values.append(np.full(np.count_nonzero(kept), self.kernel[dx + reach_x, dy + reach_y]))
+        rows = np.concatenate(rows)
+        values = np.concatenate(values) / self.on_screen.ravel()[rows]
+        transition = sparse.csr_matrix(
+            (values, (rows, np.concatenate(cols))), shape=(self.num_states, self.num_states)
+        )
+        transition.eliminate_zeros()
+        return transition
@@ -0,0 +1,235 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+from motion_kernel import displacement_kernel
+from touchscreen_helpers.model_estimation import MAX_CELL_STEP
+
+# The default number of particles
+NUM_PARTICLES = 4096
+# Resample once the effective number of particles drops below this fraction of them
+RESAMPLE_THRESHOLD = 0.5
+# After this many touches in a row that no particle could have produced, the
+# track is taken to be lost and the particles are redrawn around the touch
+LOST_FRAMES = 2
+# How far, in cells, a touch is modelled as landing from the finger; touches
+# further away are modelled as random touches anywhere on the screen
+SENSOR_REACH = 2 * MAX_CELL_STEP
+
+
+def sensor_kernel(prior, sensor, width: int, height: int, reach: int = SENSOR_REACH) -> Tuple[np.ndarray, float]:
+    """
+    Collapses a learned sensor table into a translation-invariant noise model:
+    how likely the touch is to land at each offset from the finger, up to
+    `reach` cells, and the probability of a touch landing anywhere else.
+
+    Input:
+    - prior, sensor: The tables of a trained touchscreenHMM
+    - width, height: The size of the screen the tables were learned on
+    - reach:         The furthest offset kept in the kernel
+
+    Output:
+    - (kernel, outside): kernel[reach + dx][reach + dy] is the probability of
+      the touch landing (dx, dy) from the finger, and outside is the rest
+    """
+    kernel = displacement_kernel(prior, sensor, width, height)
+    center = kernel.shape[0] // 2
+    if center < reach:
+        kernel = np.pad(kernel, reach - center)
+        center = reach
+    kernel = kernel[center - reach:center + reach + 1, center - reach:center + reach + 1]
+    return kernel, max(0.0, 1 - float(np.sum(kernel)))
+
+
+class touchscreenParticleFilter:
+    """
+    Approximate filtering for screens far too large for the exact grid filter.
+    The belief is a fixed number of weighted particles, each a finger
+    position. Every frame moves the particles by displacements sampled from a
+    motion kernel, weights them by a translation-invariant sensor model and
+    resamples them systematically when the weights degenerate, all as
+    vectorized NumPy operations whose cost does not depend on the screen size.
+
+    The belief is only scattered onto a (width x height) grid when asked for,
+    by distribution or filter_noisy_data.
+    """
+
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        motion: np.ndarray,
+        noise: np.ndarray,
+        outside: float,
+        num_particles: int = NUM_PARTICLES,
+        seed: Optional[int] = None,
+    ):
+        """
+        Input:
+        - width, height: The size of the screen
+        - motion:        An odd-sized kernel of one-frame displacements, see
+                         motion_kernel.displacement_kernel
+        - noise, outside: The sensor model, see sensor_kernel
+        - num_particles: The number of particles
+        - seed:          Seeds the sampling reproducibly if given
+        """
+        self.width = width
+        self.height = height
+        self.num_particles = num_particles
+        self.rng = np.random.default_rng(seed)
+
+        self.motion_reach = np.array(motion.shape) // 2
+        self.motion_cdf = np.cumsum(motion.ravel()) / np.sum(motion)
+        self.motion_shape = motion.shape
+        self.noise = np.asarray(noise, dtype=float)
+        self.noise_reach = np.array(self.noise.shape) // 2
+        # A touch that lands anywhere else is equally likely to land on any cell
+        self.outside = outside / (width * height)
+        # Where the finger is given only a touch: offsets from the touch, reversed
+        self.touch_cdf = np.cumsum(self.noise[::-1, ::-1].ravel()) / np.sum(self.noise)
+
+        self.grid = np.zeros((width, height))
+        self.scattered = np.zeros(0, dtype=np.int64)
+        self.reset()
+
+    @classmethod
+    def from_model(
+        cls,
+        model,
+        width: int,
+        height: int,
+        num_particles: int = NUM_PARTICLES,
+        seed: Optional[int] = None,
+    ) -> "touchscreenParticleFilter":
+        """
+        Transfers the motion and sensor models of a touchscreenHMM trained on
+        a small screen to a screen of any size, assuming both are the same
+        away from the edges.
+        """
+        motion = displacement_kernel(model.prior, model.transition_table, model.width, model.height)
+        noise, outside = sensor_kernel(model.prior, model.sensor_table, model.width, model.height)
+        return cls(width, height, motion, noise, outside, num_particles, seed)
+
+    def reset(self):
+        """
+        Forgets every frame; the next touch places the particles.
+        """
+        self.positions = None
+        self.weights = np.full(self.num_particles, 1 / self.num_particles)
+        self.misses = 0
+
+    def sample(self, cdf: np.ndarray, shape, reach: np.ndarray, count: int) -> np.ndarray:
+        """
+        Draws count offsets from a kernel, given its cumulative distribution.
+        """
+        drawn = np.minimum(np.searchsorted(cdf, self.rng.random(count), side="right"), len(cdf) - 1)
+        return np.stack(np.divmod(drawn, shape[1]), axis=1) - reach
+
+    def on_screen(self, positions: np.ndarray) -> np.ndarray:
+        return (
+            (positions[:, 0] >= 0) & (positions[:, 0] < self.width) & (positions[:, 1] >= 0) & (positions[:, 1] < self.height)
+        )
+
+    def place(self, observation):
+        """
+        Draws every particle from where the finger could be given only the touch.
+        """
+        touch = np.array(observation)
+        self.positions = touch + self.sample(self.touch_cdf, self.noise.shape, self.noise_reach, self.num_particles)
+        np.clip(self.positions, 0, [self.width - 1, self.height - 1], out=self.positions)
+        self.weights.fill(1 / self.num_particles)
+        self.misses = 0
+
+    def propagate(self):
+        """
+        Moves every particle by a sampled displacement. Moves that would leave
+        the screen are drawn again, which renormalizes the motion kernel at the
+        edges like MotionKernel does.
+        """
+        moved = self.positions + self.sample(self.motion_cdf, self.motion_shape, self.motion_reach, self.num_particles)
+        off = np.flatnonzero(~self.on_screen(moved))
+        for _ in range(8):
+            if len(off) == 0:
+                break
+            moved[off] = self.positions[off] + self.sample(self.motion_cdf, self.motion_shape, self.motion_reach, len(off))
+            off = off[~self.on_screen(moved[off])]
+        # Particles pinned against an edge stay put
+        moved[off] = self.positions[off]
+        self.positions = moved
+
+    def likelihoods(self, observation) -> np.ndarray:
+        """
+        Returns P(observation | particle) for every particle.
+        """
+        offsets = np.array(observation) - self.positions + self.noise_reach
+        near = np.all((offsets >= 0) & (offsets < self.noise.shape), axis=1)
+        likelihoods = np.full(self.num_particles, self.outside)
+        likelihoods[near] += self.noise[offsets[near, 0], offsets[near, 1]]
+        return likelihoods
+
+    def resample(self):
+        """
+        Systematic resampling: one random offset, then evenly spaced picks
+        through the cumulative weights.
+        """
+        picks = (self.rng.random() + np.arange(self.num_particles)) / self.num_particles
+        chosen = np.minimum(np.searchsorted(np.cumsum(self.weights), picks), self.num_particles - 1)
+        self.positions = self.positions[chosen]
+        self.weights.fill(1 / self.num_particles)
+
+    def tell(self, observation):
+        """
+        Records a noisy (x, y) touch.
+        """
+        if self.positions is None:
+            self.place(observation)
+            return
+        self.propagate()
+        likelihoods = self.likelihoods(observation)
+        if np.all(likelihoods <= self.outside):
+            # No particle could have produced the touch: a random touch, or a lost track
+            self.misses += 1
+            if self.misses >= LOST_FRAMES:
+                self.place(observation)
+                return
+        else:
+            self.misses = 0
+        self.weights *= likelihoods
+        total = np.sum(self.weights)
+        if total == 0:
+            self.place(observation)
+            return
+        self.weights /= total
+        if 1 / np.sum(self.weights ** 2) < RESAMPLE_THRESHOLD * self.num_particles:
+            self.resample()
+
+    def estimate(self) -> Tuple[float, float]:
+        """
+        The weighted mean position of the particles.
+        """
+        return tuple(self.weights @ self.positions)
+
+    def distribution(self) -> np.ndarray:
+        """
+        Scatters the particle weights onto the screen. The returned
+        (width x height) array is reused by the next call; only the cells the
+        previous call touched are cleared.
+        """
+        flat_grid = self.grid.ravel()
+        flat_grid[self.scattered] = 0
+        if self.positions is None:
+            flat_grid.fill(1 / flat_grid.size)
+            self.scattered = np.arange(flat_grid.size)
+            return self.grid
+        self.scattered = self.positions[:, 0] * self.height + self.positions[:, 1]
+        np.add.at(flat_grid, self.scattered, self.weights)
+        return self.grid
+
+    def filter_noisy_data(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Same contract as touchscreenHMM.filter_noisy_data: takes a noisy frame
+        or an (x, y) tuple and returns the 2D distribution of the finger.
+        """
+        position = frame if isinstance(frame, tuple) else divmod(int(np.argmax(frame)), frame.shape[1])
+        self.tell(position)
+        return self.distribution()
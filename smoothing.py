@@ -0,0 +1,242 @@
+import numpy as np
+from scipy import sparse
+
+
+class SparseProduct:
+    """
+    Computes matrix @ x for a fixed sparse matrix into preallocated buffers, so
+    a per-frame loop built on it allocates nothing.
+    """
+
+    def __init__(self, matrix):
+        matrix = sparse.csr_matrix(matrix)
+        self.num_rows = matrix.shape[0]
+        self.data = matrix.data
+        self.indices = matrix.indices
+        counts = np.diff(matrix.indptr)
+        self.all_rows = bool(np.all(counts > 0))
+        self.rows = np.flatnonzero(counts > 0)
+        self.starts = matrix.indptr[:-1][self.rows]
+        self.products = np.empty(len(self.data))
+        self.sums = np.empty(len(self.rows))
+
+    def __call__(self, x: np.ndarray, out: np.ndarray) -> np.ndarray:
+        np.take(x, self.indices, out=self.products)
+        np.multiply(self.products, self.data, out=self.products)
+        if self.all_rows:
+            np.add.reduceat(self.products, self.starts, out=out)
+        else:
+            # reduceat cannot produce an empty sum, so rows without entries are zeroed instead
+            np.add.reduceat(self.products, self.starts, out=self.sums)
+            out.fill(0)
+            out[self.rows] = self.sums
+        return out
+
+
+class FixedLagSmoother:
+    """
+    Fixed-lag smoothing for a touchscreenHMM: after each noisy frame, returns
+    the distribution of the finger `lag` frames earlier given every frame seen
+    so far, trading that much latency for accuracy.
+
+    The last lag + 1 forward (filtered) messages and the last lag emission
+    vectors are kept in preallocated ring buffers. Each frame runs one forward
+    step and a backward pass over the buffered emissions, so it costs
+    O(lag) sparse products and allocates no new arrays.
+    """
+
+    def __init__(self, model, lag: int):
+        """
+        Input:
+        - model: A trained touchscreenHMM whose tables are shared
+        - lag:   How many frames each estimate lags behind the newest frame
+        """
+        self.hmm = model.hmm
+        self.width = model.width
+        self.height = model.height
+        self.num_states = model.hmm.num_states
+        self.lag = lag
+
+        # predict(x) sums over current states for every future state, and
+        # backward(x) sums over future states for every current state
+        self.predict = SparseProduct(self.hmm.predict_matrix)
+        self.backward = SparseProduct(self.hmm.predict_matrix.T)
+
+        self.forward_messages = np.empty((lag + 1, self.num_states))
+        self.emissions = np.empty((max(lag, 1), self.num_states))
+        self.predicted = np.empty(self.num_states)
+        self.beta = np.empty(self.num_states)
+        self.weighted = np.empty(self.num_states)
+        self.smoothed = np.empty(self.num_states)
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets every frame, going back to the prior.
+        """
+        self.time = 0
+        self.forward_messages[0] = self.hmm.prior
+
+    def forward(self, observation):
+        """
+        Runs one filtering step, as HMM.tell does, into the next ring buffer slot.
+        """
+        likelihoods = self.hmm.emission(observation)
+        previous = self.forward_messages[self.time % (self.lag + 1)]
+        self.time += 1
+        current = self.forward_messages[self.time % (self.lag + 1)]
+        if self.lag:
+            np.copyto(self.emissions[self.time % self.lag], likelihoods)
+
+        self.predict(previous, self.predicted)
+        self.hmm.update(self.predicted, likelihoods, out=current)
+
+    def smooth(self, lag: int) -> np.ndarray:
+        """
+        Returns the distribution of the state `lag` frames ago given every frame
+        so far, by passing a backward message over the last `lag` emissions.
+        """
+        self.beta.fill(1)
+        for k in range(self.time, self.time - lag, -1):
+            np.multiply(self.emissions[k % self.lag], self.beta, out=self.weighted)
+            self.backward(self.weighted, self.beta)
+            total = np.sum(self.beta)
+            if total > 0:
+                self.beta /= total
+        np.multiply(self.forward_messages[(self.time - lag) % (self.lag + 1)], self.beta, out=self.smoothed)
+        total = np.sum(self.smoothed)
+        if total == 0:
+            # The buffered frames contradict the filtered estimate; fall back to it
+            np.copyto(self.smoothed, self.forward_messages[(self.time - lag) % (self.lag + 1)])
+            total = np.sum(self.smoothed)
+        self.smoothed /= total
+        return self.smoothed
+
+    def tell(self, observation):
+        """
+        Records a noisy (x, y) touch.
+
+        Output:
+        - The smoothed distribution over flat screen indices for the frame `lag`
+          frames before this one, or None while fewer than lag + 1 frames have
+          been seen. The array is reused by the next call.
+        """
+        self.forward(observation)
+        if self.time <= self.lag:
+            return None
+        return self.smooth(self.lag)
+
+    def flush(self):
+        """
+        Returns the smoothed distributions of the last `lag` frames, which tell
+        has not reported yet, oldest first, as a (frames x width x height) array.
+        """
+        pending = min(self.lag, self.time)
+        smoothed = np.empty((pending, self.num_states))
+        for i, lag in enumerate(range(pending - 1, -1, -1)):
+            smoothed[i] = self.smooth(lag)
+        return smoothed.reshape(pending, self.width, self.height)
+
+    def filter_noisy_data(self, frame):
+        """
+        Like touchscreenHMM.filter_noisy_data, but the returned 2D distribution is
+        for the frame `lag` frames before this one (None until there is one).
+        """
+        position = frame if isinstance(frame, tuple) else divmod(int(np.argmax(frame)), frame.shape[1])
+        smoothed = self.tell(position)
+        return None if smoothed is None else smoothed.reshape(self.width, self.height)
+
+
+def forward_backward_segments(hmm, observations, segment_length=None):
+    """
+    Runs scaled forward-backward over a whole sequence of noisy touches,
+    keeping only O(sqrt(T)) messages in memory. A first forward pass keeps the
+    forward message at the start of every segment of segment_length frames (the
+    checkpoints); then, from the last segment back to the first, the forward
+    messages of one segment are recomputed from its checkpoint and combined with
+    the backward message carried back from the segment after it.
+
+    Like HMM.tell, every touch follows one transition, starting from hmm.prior.
+
+    Input:
+    - hmm:            A touchscreen HMM (touchscreenHMM.hmm)
+    - observations:   A (T x 2) integer array of noisy (x, y) touches
+    - segment_length: Frames per segment, ceil(sqrt(T)) by default
+
+    Output:
+    - An iterator, last segment first, of (start, checkpoint, alphas, betas,
+      likelihoods, scales). checkpoint is the forward message just before the
+      segment, and row i of each other array belongs to frame start + i: the
+      scaled forward and backward messages, the emission vector, and the
+      forward normalizer (0 where the track was lost and restarted from the touch)
+    """
+    observations = np.asarray(observations)
+    frames = len(observations)
+    if segment_length is None:
+        segment_length = max(1, int(np.ceil(np.sqrt(frames))))
+
+    # Emission vectors come from the HMM's bounded cache, one segment at a time
+    flat = observations[:, 0] * hmm.height + observations[:, 1]
+
+    def forward(alpha, start, end, alphas=None, scales=None):
+        likelihoods = np.stack([hmm.emission(hmm.mapToState[o]) for o in flat[start:end].tolist()])
+        for i in range(end - start):
+            alpha, scale = hmm.update(hmm.predict_matrix @ alpha, likelihoods[i])
+            if alphas is not None:
+                alphas[i] = alpha
+                scales[i] = scale
+        return alpha, likelihoods
+
+    checkpoints = [np.asarray(hmm.prior, dtype=float)]
+    for start in range(0, frames, segment_length):
+        alpha, _ = forward(checkpoints[-1], start, min(start + segment_length, frames))
+        checkpoints.append(alpha)
+
+    beta = np.ones(hmm.num_states)
+    transition = hmm.predict_matrix.T.tocsr()
+    for segment in range(len(checkpoints) - 2, -1, -1):
+        start = segment * segment_length
+        end = min(start + segment_length, frames)
+        alphas = np.empty((end - start, hmm.num_states))
+        betas = np.empty((end - start, hmm.num_states))
+        scales = np.empty(end - start)
+        _, likelihoods = forward(checkpoints[segment], start, end, alphas, scales)
+        for i in range(end - start - 1, -1, -1):
+            betas[i] = beta
+            if scales[i] == 0:
+                # The track restarted here, so earlier frames learn nothing from later ones
+                beta = np.ones(hmm.num_states)
+            else:
+                beta = transition @ (likelihoods[i] * beta) / scales[i]
+                total = np.sum(beta)
+                beta = beta / total if total > 0 else np.ones(hmm.num_states)
+        yield start, checkpoints[segment], alphas, betas, likelihoods, scales
+
+
+def forward_backward(model, observations, out=None, segment_length=None) -> np.ndarray:
+    """
+    Smoothed posteriors for every frame of a whole sequence of noisy touches,
+    using O(sqrt(T)) working memory (see forward_backward_segments).
+
+    Input:
+    - model:          A trained touchscreenHMM
+    - observations:   A (T x 2) integer array of noisy (x, y) touches
+    - out:            Optional (T x num_states) array to write into, such as a
+                      np.memmap, so the posteriors need not fit in memory
+    - segment_length: Frames per checkpointed segment, ceil(sqrt(T)) by default
+
+    Output:
+    - A (T x num_states) array; row t is the distribution of the finger at frame t
+      given every frame. Reshape a row to (width, height) for a 2D frame.
+    """
+    if out is None:
+        out = np.empty((len(observations), model.hmm.num_states))
+    for start, _, alphas, betas, _, _ in forward_backward_segments(model.hmm, observations, segment_length):
+        posteriors = alphas * betas
+        totals = np.sum(posteriors, axis=1, keepdims=True)
+        # Frames whose later evidence contradicts them keep their filtered estimate
+        contradicted = totals[:, 0] == 0
+        posteriors[contradicted] = alphas[contradicted]
+        totals[contradicted] = 1
+        out[start:start + len(alphas)] = posteriors / totals
+    return out
@@ -0,0 +1,309 @@
+import argparse
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from touchscreen import touchscreenBatchHMM, touchscreenHMM
+from touchscreen_helpers import simulation_io
+from touchscreen_helpers.simulator import touchscreenSimulator
+
+# The most devices with a live filter session; the least recently seen
+# device is evicted to make room for a new one
+MAX_SESSIONS = 1024
+# Sessions idle for this many seconds are evicted
+IDLE_TIMEOUT = 60.0
+# How long frames are collected before they are filtered together, in seconds
+TICK = 0.001
+
+
+class SessionPool:
+    """
+    Filter sessions for many devices, sharing one touchscreenBatchHMM: every
+    device is given a stream (a row of the batch), and the streams of
+    devices that leave or go idle are reset and reused.
+    """
+
+    def __init__(self, model: touchscreenHMM, max_sessions: int = MAX_SESSIONS, idle_timeout: float = IDLE_TIMEOUT):
+        self.batch = touchscreenBatchHMM(model, max_sessions)
+        self.idle_timeout = idle_timeout
+        self.streams: Dict[str, int] = {}
+        self.last_seen = np.zeros(max_sessions)
+        self.free = list(range(max_sessions - 1, -1, -1))
+
+    def stream(self, device: str, now: float, busy=()) -> int:
+        """
+        Returns the stream of a device, starting a session if it has none. To
+        make room, the least recently seen session whose stream is not in busy
+        (such as the streams already in the update being built) is evicted.
+        """
+        stream = self.streams.get(device)
+        if stream is None:
+            if not self.free:
+                idle = [d for d, s in self.streams.items() if s not in busy]
+                self.evict(min(idle, key=lambda d: self.last_seen[self.streams[d]]))
+            stream = self.free.pop()
+            self.streams[device] = stream
+        self.last_seen[stream] = now
+        return stream
+
+    def evict(self, device: str):
+        stream = self.streams.pop(device, None)
+        if stream is not None:
+            self.batch.reset([stream])
+            self.free.append(stream)
+
+    def evict_idle(self, now: float) -> int:
+        """
+        Evicts every session idle for longer than the timeout, and returns how many.
+        """
+        idle = [device for device, stream in self.streams.items() if now - self.last_seen[stream] > self.idle_timeout]
+        for device in idle:
+            self.evict(device)
+        return len(idle)
+
+
+class TouchServer:
+    """
+    Filters noisy touches streamed by many devices over TCP or a Unix socket.
+
+    The protocol is line based. A client sends "<device> <x> <y>" for each
+    frame and gets back "<device> <x> <y> <probability>": the most
+    likely finger location. With top_k set, the reply is instead
+    "<device> <x>,<y>:<probability> ..." for the top_k most likely cells.
+    "RESET <device>" ends a device's session once the frames it sent before
+    are filtered. Each device's replies come in the order its frames were sent.
+
+    Frames from every connection are collected for one tick and then filtered
+    with a single vectorized touchscreenBatchHMM update; a device that sent
+    several frames in the same tick has them filtered in order over the
+    following updates.
+    """
+
+    def __init__(self, pool: SessionPool, tick: float = TICK, top_k: Optional[int] = None):
+        self.pool = pool
+        self.tick = tick
+        self.top_k = top_k
+        self.width = pool.batch.width
+        self.height = pool.batch.height
+        # Frames waiting for the next update: (device, x, y, writer), or
+        # (device, None, None, None) for a reset
+        self.pending: List[Tuple[str, int, int, asyncio.StreamWriter]] = []
+        self.flush_handle = None
+        self.frames = 0
+        self.updates = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            async for line in reader:
+                try:
+                    fields = line.decode().split()
+                    if len(fields) == 2 and fields[0] == "RESET":
+                        self.reset(fields[1])
+                    elif len(fields) == 3:
+                        self.submit(fields[0], int(fields[1]), int(fields[2]), writer)
+                    elif fields:
+                        raise ValueError
+                except ValueError:
+                    # A malformed line only gets an error; the connection stays open
+                    writer.write(b"ERROR expected '<device> <x> <y>' or 'RESET <device>'\n")
+                # Stop reading from a client that isn't reading its replies, so
+                # its output buffer stays bounded
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def submit(self, device: str, x: int, y: int, writer: asyncio.StreamWriter):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            writer.write(b"ERROR touch outside the screen\n")
+            return
+        self.enqueue((device, x, y, writer))
+
+    def reset(self, device: str):
+        """
+        Ends a device's session, in order behind the frames it already sent.
+        """
+        self.enqueue((device, None, None, None))
+
+    def enqueue(self, entry: tuple):
+        self.pending.append(entry)
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.tick, self.flush)
+
+    def flush(self):
+        """
+        Filters every pending frame, one batched update per frame a single device sent.
+        """
+        self.flush_handle = None
+        pending, self.pending = self.pending, []
+        now = time.monotonic()
+        while pending:
+            # Take each device's oldest frame; the rest wait for the next update
+            batch, streams, busy, later, seen = [], [], set(), [], set()
+            for entry in pending:
+                device, x, y, _ = entry
+                if device in seen or len(batch) == len(self.pool.last_seen):
+                    later.append(entry)
+                    seen.add(device)
+                elif x is None:
+                    # Every frame the device sent before the reset has been filtered
+                    self.pool.evict(device)
+                else:
+                    # Never evict a stream this update already uses
+                    stream = self.pool.stream(device, now, busy)
+                    busy.add(stream)
+                    streams.append(stream)
+                    batch.append(entry)
+                    seen.add(device)
+            pending = later
+            if not batch:
+                continue
+
+            positions = np.array([(x, y) for _, x, y, _ in batch])
+            probabilities = self.pool.batch.tell(positions, np.array(streams))
+            self.updates += 1
+            self.frames += len(batch)
+            for (device, _, _, writer), distribution in zip(batch, probabilities):
+                # The client may have disconnected since sending the frame
+                if not writer.is_closing():
+                    writer.write(self.reply(device, distribution))
+
+    def reply(self, device: str, distribution: np.ndarray) -> bytes:
+        if self.top_k is None:
+            state = int(np.argmax(distribution))
+            x, y = divmod(state, self.height)
+            return f"{device} {x} {y} {distribution[state]:.6g}\n".encode()
+        top = np.argpartition(distribution, -self.top_k)[-self.top_k:]
+        top = top[np.argsort(distribution[top])[::-1]]
+        cells = " ".join(f"{s // self.height},{s % self.height}:{distribution[s]:.6g}" for s in top)
+        return f"{device} {cells}\n".encode()
+
+    async def evict_idle(self):
+        while True:
+            await asyncio.sleep(self.pool.idle_timeout / 2)
+            self.pool.evict_idle(time.monotonic())
+
+
+async def serve(
+    width: int = 20,
+    height: int = 20,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    unix_path: Optional[str] = None,
+    max_sessions: int = MAX_SESSIONS,
+    idle_timeout: float = IDLE_TIMEOUT,
+    tick: float = TICK,
+    top_k: Optional[int] = None,
+):
+    """
+    Trains (or loads) a touchscreenHMM and serves it until cancelled.
+    """
+    server = TouchServer(SessionPool(touchscreenHMM(width, height), max_sessions, idle_timeout), tick, top_k)
+    if unix_path:
+        listener = await asyncio.start_unix_server(server.handle, unix_path)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+    print(f"Serving on {unix_path or f'{host}:{port}'}.")
+    eviction = asyncio.create_task(server.evict_idle())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        eviction.cancel()
+
+
+async def run_device(device: str, positions: np.ndarray, connect, latencies: List[float]):
+    """
+    Streams one device's simulated frames, sending each once the previous
+    one is answered, and records the round-trip latencies.
+    """
+    reader, writer = await connect()
+    for x, y in positions[:, :2].tolist():
+        start = time.perf_counter()
+        writer.write(f"{device} {x} {y}\n".encode())
+        await reader.readline()
+        latencies.append(time.perf_counter() - start)
+    writer.write(f"RESET {device}\n".encode())
+    writer.close()
+
+
+async def load_test(
+    devices: int = 50,
+    frames: int = 200,
+    width: int = 20,
+    height: int = 20,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    unix_path: Optional[str] = None,
+) -> dict:
+    """
+    Simulates many devices touching at once against a running server.
+
+    Output:
+    - The frames per second served, and the round-trip latency percentiles in milliseconds
+    """
+    runs = []
+    for _ in range(devices):
+        simulator = touchscreenSimulator(width, height, frames)
+        simulator.run_simulation()
+        runs.append(simulation_io.simulation_positions(simulator))
+
+    def connect():
+        if unix_path:
+            return asyncio.open_unix_connection(unix_path)
+        return asyncio.open_connection(host, port)
+
+    latencies: List[float] = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_device(f"device{i}", run, connect, latencies) for i, run in enumerate(runs)))
+    elapsed = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000
+    report = {"frames": len(latencies), "seconds": elapsed, "frames_per_s": len(latencies) / elapsed}
+    report.update({f"p{p}_ms": float(np.percentile(latencies_ms, p)) for p in (50, 90, 99)})
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve touchscreen filtering, or load test a server")
+    parser.add_argument("mode", choices=["serve", "load"], help="run the server, or the load generator")
+    parser.add_argument("--width", type=int, default=20, help="the width of the touchscreen")
+    parser.add_argument("--height", type=int, default=20, help="the height of the touchscreen")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="the TCP host")
+    parser.add_argument("--port", type=int, default=8765, help="the TCP port")
+    parser.add_argument("--unix", type=str, help="a Unix socket path to use instead of TCP")
+    parser.add_argument("--max_sessions", type=int, default=MAX_SESSIONS, help="the most concurrent device sessions")
+    parser.add_argument("--idle_timeout", type=float, default=IDLE_TIMEOUT, help="seconds before idle sessions are evicted")
+    parser.add_argument("--tick", type=float, default=TICK, help="seconds frames are collected before filtering")
+    parser.add_argument("--top_k", type=int, help="reply with the top k cells instead of the most likely one")
+    parser.add_argument("--devices", type=int, default=50, help="the number of simulated devices (load)")
+    parser.add_argument("--frames", type=int, default=200, help="the frames each device sends (load)")
+    args = parser.parse_args()
+
+    if args.mode == "serve":
+        try:
+            asyncio.run(
+                serve(
+                    args.width,
+                    args.height,
+                    args.host,
+                    args.port,
+                    args.unix,
+                    args.max_sessions,
+                    args.idle_timeout,
+                    args.tick,
+                    args.top_k,
+                )
+            )
+        except KeyboardInterrupt:
+            pass
+    else:
+        report = asyncio.run(
+            load_test(args.devices, args.frames, args.width, args.height, args.host, args.port, args.unix)
+        )
+        print(
+            f"{report['frames']} frames in {report['seconds']:.2f}s, {report['frames_per_s']:.0f} frames/s, "
+            f"latency p50 {report['p50_ms']:.2f}ms p90 {report['p90_ms']:.2f}ms p99 {report['p99_ms']:.2f}ms"
+        )
@@ -1,10 +1,40 @@
+import gc
+import os
+
 import numpy as np
+from scipy import sparse
+from touchscreen_helpers import model_store
 from touchscreen_helpers.generate_data import create_simulations
+from touchscreen_helpers.model_estimation import (
+    MAX_CELL_STEP,
+    count_simulation,
+    parallel_counts,
+    velocity_index,
+)
 from typing import Callable, List
-from touchscreen_helpers.simulator import touchscreenSimulator
+from motion_kernel import MotionKernel
+from smoothing import FixedLagSmoother, forward_backward
+from emission_cache import EmissionCache
+from viterbi import Viterbi
 
 # Implement part 2 here!
 
+# The number of simulated frames the touchscreen models are learned from
+TRAINING_FRAMES = 1000000
+# The number of processes that simulate the training frames; 1 trains in-process
+TRAINING_WORKERS = int(os.environ.get("TOUCHSCREEN_TRAINING_WORKERS", 1))
+# Set to "numpy" to learn from the seedable touchscreenBatchSimulator instead of
+# the compiled touchscreenSimulator; each is cached separately
+TRAINING_SIMULATOR = os.environ.get("TOUCHSCREEN_TRAINING_SIMULATOR", "compiled")
+# Set to 1 to predict with a translation-invariant motion kernel instead of the
+# learned transition table (see touchscreenHMM.use_motion_kernel)
+MOTION_KERNEL = os.environ.get("TOUCHSCREEN_MOTION_KERNEL", "0") == "1"
+# The memory the emission vectors of each HMM may take, in bytes
+EMISSION_CACHE_BYTES = 256 * 1024 * 1024
+# The default mass below which states are dropped from the beam (see HMM.use_beam)
+BEAM_THRESHOLD = 1e-6
+
+
 class HMM:
 
     # You may add instance variables, but you may not change the
@@ -13,6 +43,9 @@ class HMM:
     sensor_model = None
     transition_model = None
     probabilities = None
+    # Pruned filtering, off unless use_beam is called
+    beam_threshold = None
+    beam_size = None
 
     def __init__(
         self,
@@ -24,30 +57,275 @@ class HMM:
         # Initialize your HMM here!
         self.sensor_model = sensor_model
         self.transition_model = transition_model
+        self.width = width
+        self.height = height
         self.num_states = width * height
          #in each cell, divide each by num_states
         self.mapToState = {w*height + h: (w, h) for w in range(width) for h in range(height)}
         self.probabilities = np.array([self.transition_model((-1, -1), (w, h)) for w in range(width) for h in range(height)])
         self.probabilities = self.probabilities / np.sum(self.probabilities)
+        self.prior = self.probabilities
+
+        # transition[s][s'] = P(s' | s) only for the reachable neighbourhood of s
+        self.transition = self.compile_transitions(MAX_CELL_STEP)
+        # predict_matrix @ probabilities sums over the current states for every future state
+        self.predict_matrix = self.transition.T.tocsr()
+        # An optional MotionKernel that replaces predict_matrix in predict
+        self.motion = None
+        self.emission_matrix = None
+        self.emission_cache = EmissionCache(self.compute_emission, self.emission_cache_size())
+
+    @classmethod
+    def from_tables(
+        cls,
+        prior,
+        transition,
+        sensor,
+        width: int,
+        height: int,
+        sensor_model=None,
+        transition_model=None,
+    ) -> "HMM":
+        """
+        Builds an HMM straight from compiled tables, without calling a model
+        function for every pair of states. Tables stored column-major (CSC) are
+        used without copying, so memory-mapped tables stay shared.
+
+        Input:
+        - prior:      The distribution of the first state, a NumPy array of length width * height
+        - transition: A sparse matrix with transition[s][s'] = P(s' | s)
+        - sensor:     A sparse matrix with sensor[s][o] = P(o | s), o being a state index
+        - width:      The width of the screen
+        - height:     The height of the screen
+        - sensor_model, transition_model: The functions the tables were built
+          from, if any, kept for callers that want to query them directly
+        """
+        hmm = cls.__new__(cls)
+        hmm.width = width
+        hmm.height = height
+        hmm.num_states = width * height
+        hmm.mapToState = {w*height + h: (w, h) for w in range(width) for h in range(height)}
+        hmm.probabilities = np.asarray(prior) / np.sum(prior)
+        hmm.prior = hmm.probabilities
+        hmm.transition = transition
+        hmm.predict_matrix = transition.T.tocsr()
+        hmm.motion = None
+        hmm.emission_matrix = sensor.T.tocsr()
+        hmm.emission_cache = EmissionCache(hmm.compute_emission, hmm.emission_cache_size())
+        hmm.sensor_model = sensor_model
+        hmm.transition_model = transition_model
+        return hmm
+
+    def compile_transitions(self, max_step: int) -> sparse.csr_matrix:
+        """
+        Calls the transition model for every pair of states at most max_step
+        cells apart (in both directions) and stores the non-zero results.
+
+        Input:
+        - max_step: The furthest the finger can move in one frame, in cells
+
+        Output:
+        - A (num_states x num_states) sparse CSR matrix, indexed [current][future]
+        """
+        ws, hs = np.divmod(np.arange(self.num_states), self.height)
+        rows = []
+        cols = []
+        for dw in range(-max_step, max_step + 1):
+            for dh in range(-max_step, max_step + 1):
+                nw = ws + dw
+                nh = hs + dh
+                on_screen = (nw >= 0) & (nw < self.width) & (nh >= 0) & (nh < self.height)
+                rows.append(np.flatnonzero(on_screen))
+                cols.append(nw[on_screen] * self.height + nh[on_screen])
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        values = np.array(
+            [self.transition_model(self.mapToState[cs], self.mapToState[fs]) for cs, fs in zip(rows, cols)],
+            dtype=float,
+        )
+        transition = sparse.csr_matrix((values, (rows, cols)), shape=(self.num_states, self.num_states))
+        transition.eliminate_zeros()
+        return transition
+
+    def emission_cache_size(self) -> int:
+        """
+        Every observation is a screen cell, so the cache holds all of them if
+        they fit in EMISSION_CACHE_BYTES, and as many as fit otherwise.
+        """
+        return min(self.num_states, EMISSION_CACHE_BYTES // (8 * self.num_states))
+
+    def compute_emission(self, observation) -> np.ndarray:
+        if self.emission_matrix is not None:
+            o = observation[0]*self.height + observation[1]
+            start, end = self.emission_matrix.indptr[o], self.emission_matrix.indptr[o + 1]
+            likelihoods = np.zeros(self.num_states)
+            likelihoods[self.emission_matrix.indices[start:end]] = self.emission_matrix.data[start:end]
+            return likelihoods
+        return np.array(
+            [self.sensor_model(observation, self.mapToState[s]) for s in range(self.num_states)],
+            dtype=float,
+        )
+
+    def sensor_row(self, observation):
+        """
+        Returns the states an observation can come from, as state indices,
+        and its non-zero likelihood from each. Read straight from the
+        sensor table when there is one, so it costs nothing per screen cell.
+        """
+        if self.emission_matrix is None:
+            likelihoods = self.emission(observation)
+            states = np.flatnonzero(likelihoods)
+            return states, likelihoods[states]
+        o = observation[0]*self.height + observation[1]
+        start, end = self.emission_matrix.indptr[o], self.emission_matrix.indptr[o + 1]
+        return self.emission_matrix.indices[start:end], self.emission_matrix.data[start:end]
+
+    def emission(self, observation) -> np.ndarray:
+        """
+        Returns P(observation | state) for every state, calling the sensor
+        model only when the observation is not in the emission cache.
+        """
+        return self.emission_cache.lookup(observation)
+
+    def predict(self, probabilities: np.ndarray) -> np.ndarray:
+        """
+        Returns the distribution one frame later. Takes an array of length
+        num_states, or (K x num_states) for K independent streams.
+        """
+        if self.motion is not None:
+            return self.motion.predict(probabilities)
+        if probabilities.ndim == 1:
+            return self.predict_matrix @ probabilities
+        return (self.predict_matrix @ probabilities.T).T
+
+    @staticmethod
+    def update(predicted, likelihoods, restart_weights=1.0, axis=-1, out=None):
+        """
+        Weights predicted distributions by the likelihoods of an observation
+        and normalizes them. Every filter goes through here, so they all
+        recover from a lost track the same way: when the observation is
+        impossible from every predicted state, the distribution starts over
+        from what the sensor model allows, and when that is empty too nothing
+        is known about the observation and the prediction is kept.
+
+        Input:
+        - predicted:       The predicted distribution, or one per row for K streams
+        - likelihoods:     P(observation | state), broadcast against predicted
+        - restart_weights: Weights the likelihoods when starting over, broadcast
+                           against predicted
+        - axis:            The axis each distribution sums over, None for all of them
+        - out:             Optional array of predicted's shape for the result
+
+        Output:
+        - (distributions, scales): the normalized distributions, and the total
+          each had before normalizing, which is 0 where the track was lost
+        """
+        weighted = np.multiply(predicted, likelihoods, out=out)
+        scales = np.sum(weighted, axis=axis, keepdims=True)
+        totals = scales
+        if not np.all(scales):
+            lost = scales == 0
+            np.copyto(weighted, restart_weights * likelihoods, where=lost)
+            totals = np.sum(weighted, axis=axis, keepdims=True)
+            unknown = totals == 0
+            if np.any(unknown):
+                np.copyto(weighted, predicted, where=unknown)
+                totals = np.sum(weighted, axis=axis, keepdims=True)
+        weighted /= totals
+        return weighted, np.squeeze(scales, axis=axis)
+
+    def use_beam(self, threshold: float = BEAM_THRESHOLD, top_k: int = None):
+        """
+        Switches tell to pruned (beam) filtering: only the states holding
+        noticeable mass are kept as an active set, and each step expands it to
+        their reachable neighbourhoods, weights those by the sensor model and
+        prunes again. Each frame then costs time proportional to the support
+        of the belief rather than to the screen. Pass no limits to switch back
+        to exact filtering.
+
+        Input:
+        - threshold: States with less than this share of the mass are dropped
+        - top_k:     At most this many of the most likely states are kept
+
+        The mass dropped by the last frame is in pruned_mass, and the mass
+        dropped since use_beam in total_pruned_mass. Beam filtering always
+        uses the transition table, even when a motion kernel is set.
+        """
+        self.beam_threshold = threshold
+        self.beam_size = top_k
+        if threshold is None and top_k is None:
+            return
+        # The successors of a state are a row slice of a CSR table
+        self.successors = sparse.csr_matrix(self.transition)
+        self.active = np.flatnonzero(self.probabilities)
+        self.probabilities = np.array(self.probabilities, dtype=float)
+        self.pruned_mass = 0.0
+        self.total_pruned_mass = 0.0
+
+    def reset(self):
+        """
+        Forgets every observation, going back to the prior.
+        """
+        self.probabilities = self.prior
+        if self.beam_threshold is not None or self.beam_size is not None:
+            self.active = np.flatnonzero(self.prior)
+            self.probabilities = np.array(self.prior, dtype=float)
+
+    def tell_pruned(self, observation):
+        """
+        tell for beam filtering, see use_beam. The returned array is updated
+        in place by the next call.
+        """
+        states, values = self.sensor_row(observation)
+        weights = self.probabilities[self.active]
+
+        # Gather the non-zero transitions out of every active state
+        starts = self.successors.indptr[self.active]
+        lengths = self.successors.indptr[self.active + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        entries = np.arange(np.sum(lengths)) + offsets
+        reached, inverse = np.unique(self.successors.indices[entries], return_inverse=True)
+        predicted = np.bincount(
+            inverse, weights=self.successors.data[entries] * np.repeat(weights, lengths), minlength=len(reached)
+        )
+
+        # The update runs over the reached states and the states the observation
+        # can come from, so a frame costs nothing per screen cell and a lost
+        # track can still start over from the sensor model
+        support = np.union1d(reached, states)
+        support_predicted = np.zeros(len(support))
+        support_predicted[np.searchsorted(support, reached)] = predicted
+        likelihoods = np.zeros(len(support))
+        likelihoods[np.searchsorted(support, states)] = values
+        future_probabilities, _ = self.update(support_predicted, likelihoods)
+        reached = support
+
+        keep = future_probabilities > 0
+        if self.beam_threshold is not None:
+            keep &= future_probabilities >= self.beam_threshold
+        if self.beam_size is not None and np.count_nonzero(keep) > self.beam_size:
+            ranked = np.where(keep, future_probabilities, -1)
+            keep[np.argpartition(ranked, -self.beam_size)[:-self.beam_size]] = False
+        if not np.any(keep):
+            # Never drop everything; keep the most likely state
+            keep[np.argmax(future_probabilities)] = True
+        kept_mass = np.sum(future_probabilities[keep])
+        self.pruned_mass = 1 - kept_mass
+        self.total_pruned_mass += self.pruned_mass
+
+        self.probabilities[self.active] = 0
+        self.active = reached[keep]
+        self.probabilities[self.active] = future_probabilities[keep] / kept_mass
+        return self.probabilities
 
     def tell(self, observation):
-        future_probabilities = np.zeros((self.num_states)) #num_state number of zeroes
-
-        for fs in range(0, self.num_states): #From 0 to num_states
-          for cs in range(0, self.num_states): #from 0 to num_states
-            future_state = self.mapToState[fs]
-            current_state = self.mapToState[cs]
-            #In each future_state, it equals to the curren_state * the transition model value
-            # print(f"current prob {self.probabilities[cs]}")
-            # print(f"transition prob {self.transition_model(current_state, future_state)}")
-            # print(f"future state {future_state}  current state{current_state}\n\n\n")
-            future_probabilities[fs] += self.probabilities[cs] * self.transition_model(current_state, future_state)
-          #In each future state, times the value by the sensor model value
-          future_probabilities[fs] *= self.sensor_model(observation, future_state)
-        
+        if self.beam_threshold is not None or self.beam_size is not None:
+            return self.tell_pruned(observation)
+        # Predict over the reachable neighbourhoods, then weight by the sensor model
+        likelihoods = self.emission(observation)
+        predicted = self.predict(self.probabilities)
         #Derive alpha value by dividing by the total sum of the future probabilities s.t. the values equal to 1
-        self.probabilities = future_probabilities / np.sum(future_probabilities)
-        #self.probabilities = self.probabilities / np.sum(self.probabilities)
+        self.probabilities, _ = self.update(predicted, likelihoods)
         return self.probabilities
 
 
@@ -63,8 +341,72 @@ class touchscreenHMM:
         """
         self.width = width
         self.height = height
-        self.generate_models()
-        self.hmm = HMM(self._sensor_model, self._transition_model, self.width, self.height)
+        self.num_states = width * height
+        self.frames = TRAINING_FRAMES
+        self.workers = TRAINING_WORKERS
+        self.simulator = TRAINING_SIMULATOR
+        if not self.load_models():
+            self.generate_models()
+            self.save_models()
+        self.build_hmm()
+
+    @classmethod
+    def attach(cls, tables: "model_store.SharedTables | str") -> "touchscreenHMM":
+        """
+        Builds a touchscreenHMM on tables another process published with
+        publish_models, without training, loading or copying them. Meant for
+        worker processes; see model_store.SharedTables. Call close() to detach.
+
+        Input:
+        - tables: The SharedTables, or the name of their shared memory block
+        """
+        if isinstance(tables, str):
+            tables = model_store.SharedTables.attach(tables)
+        model = cls.__new__(cls)
+        model.width = tables.metadata["width"]
+        model.height = tables.metadata["height"]
+        model.num_states = model.width * model.height
+        model.frames = tables.metadata["frames"]
+        model.workers = TRAINING_WORKERS
+        model.simulator = tables.metadata.get("simulator", "compiled")
+        # The views into the shared memory are only valid while it is attached
+        model.shared_tables = tables
+        model.use_arrays(tables.arrays)
+        model.build_hmm()
+        return model
+
+    def close(self):
+        """
+        Detaches a model built by attach from its shared tables, dropping its
+        views into them first. The model can't filter afterwards, and neither
+        can anything built on it, such as a touchscreenBatchHMM.
+        """
+        tables = getattr(self, "shared_tables", None)
+        if tables is None:
+            return
+        del self.prior, self.transition_table, self.sensor_table, self.velocity_prior, self.velocity_table
+        self.hmm = None
+        self.shared_tables = None
+        # The HMM refers to itself through its emission cache, so it and its
+        # views are only freed by the garbage collector
+        gc.collect()
+        tables.close()
+
+    def build_hmm(self):
+        """
+        Builds the filtering HMM on the current tables.
+        """
+        self.hmm = HMM.from_tables(
+            self.prior,
+            self.transition_table,
+            self.sensor_table,
+            self.width,
+            self.height,
+            self._sensor_model,
+            self._transition_model,
+        )
+        if MOTION_KERNEL:
+            self.use_motion_kernel()
 
     # NOTE: _sensor_model and _transition_model are private helper functions,
     # which means that they will only be called by you. This also means you are
@@ -72,53 +414,81 @@ class touchscreenHMM:
     # even delete them! They are only here to point you in the right direction.
 
     def arr_to_pos(self, arr):
-        return tuple(map(lambda x: x[0], np.where(arr)))
+        # The single touch is the largest entry, found without building index arrays
+        return divmod(int(np.argmax(arr)), arr.shape[1])
 
-    def generate_models(self):
-        #simulations = tuple(map(lambda arr: tuple(map(lambda x: x[0], np.where(arr))), create_simulations(1)[0]))
-        frames = 1000000
-        sim = touchscreenSimulator(width=self.width, height=self.width, frames=frames)
-        sim.run_simulation()
-        sim_data = []
-        for _ in range(frames):
-            sim_data.append(sim.get_frame(actual_position=True))
-    
-        simulations = tuple(map(lambda simulation: tuple(map(lambda arr: self.arr_to_pos(arr), simulation)), sim_data))
-        #print(f"simulations\n\n\n\n{simulations}")
-        tr_map = {}
-        sn_map = {}
-        prev_st = (-1, -1)
-
-        for sim in simulations:
-            # initialize transitions
-            st = sim[1]
-            prev_st_tr = tr_map.setdefault(prev_st, {})
-            prev_st_tr[st] = prev_st_tr.get(st, 0) + 1  
-            prev_st = st
-
-            # Initialize observations/sensors
-            obs = sim[0]
-            st_sn = sn_map.setdefault(st, {})
-            st_sn[obs] = st_sn.get(obs, 0) + 1
-        
-        for prev_st in tr_map:
-            count = sum(tr_map[prev_st].values())
-            for st in tr_map[prev_st]:
-                tr_map[prev_st][st] = tr_map[prev_st][st]/count 
+    def pos_to_index(self, pos):
+        return pos[0] * self.height + pos[1]
 
-        for obs in sn_map:
-            count = sum(sn_map[obs].values())
-            for st in sn_map[obs]:
-                sn_map[obs][st] = sn_map[obs][st]/count 
+    def load_models(self) -> bool:
+        """
+        Memory-maps previously trained tables for this screen size and number of
+        training frames, if they have been saved. Returns whether it succeeded.
+        """
+        loaded = model_store.load_tables(self.artifact_path())
+        if loaded is None:
+            return False
+        self.use_arrays(loaded[0])
+        return True
 
-        self.sn_model = sn_map
-        self.tr_model = tr_map
+    def use_arrays(self, arrays):
+        """
+        Takes the tables from arrays stored by model_arrays, without copying them.
+        """
+        shape = (self.num_states, self.num_states)
+        self.prior = arrays["prior"]
+        self.transition_table = model_store.arrays_to_sparse(arrays, "transition", shape)
+        self.sensor_table = model_store.arrays_to_sparse(arrays, "sensor", shape)
+        self.velocity_prior = arrays["velocity_prior"]
+        self.velocity_table = arrays["velocity_transition"]
+
+    def model_arrays(self):
+        """
+        Returns the tables as named flat arrays, and the metadata describing them.
+        """
+        arrays = {"prior": np.asarray(self.prior, dtype=float)}
+        arrays.update(model_store.sparse_to_arrays("transition", self.transition_table))
+        arrays.update(model_store.sparse_to_arrays("sensor", self.sensor_table))
+        arrays["velocity_prior"] = np.asarray(self.velocity_prior, dtype=float)
+        arrays["velocity_transition"] = np.asarray(self.velocity_table, dtype=float)
+        metadata = {"width": self.width, "height": self.height, "frames": self.frames, "simulator": self.simulator}
+        return arrays, metadata
+
+    def artifact_path(self) -> str:
+        return model_store.artifact_path(self.width, self.height, self.frames, simulator=self.simulator)
+
+    def save_models(self):
+        """
+        Saves the trained tables so later touchscreenHMMs can load them instead
+        of running the simulator again.
+        """
+        arrays, metadata = self.model_arrays()
+        model_store.save_tables(self.artifact_path(), arrays, metadata)
+        # Switch to the memory-mapped copy so this process shares it as well
+        self.load_models()
 
-        #print(f"SN MAP \n\n\n\n\n\n {sn_map}")
-        #print(f"TR MAP \n\n\n\n\n\n {tr_map}")
-           
+    def publish_models(self) -> model_store.SharedTables:
+        """
+        Copies the tables into shared memory once, so worker processes can
+        attach to them with touchscreenHMM.attach instead of each holding a
+        copy. Call close() on the result once the workers are done.
+        """
+        return model_store.SharedTables.publish(*self.model_arrays())
 
-        return
+    def generate_models(self):
+        """
+        Learns the prior, transition and sensor tables from a simulation, counting
+        the frames in fixed-size chunks so memory stays bounded however many
+        frames are used. With more than one worker, the frames are split across
+        independent simulations in a process pool. See TRAINING_SIMULATOR for
+        where the frames come from.
+        """
+        if self.workers > 1:
+            counts = parallel_counts(self.width, self.height, self.frames, self.workers, simulator=self.simulator)
+        else:
+            counts = count_simulation(self.width, self.height, self.frames, simulator=self.simulator)
+        self.prior, self.transition_table, self.sensor_table = counts.tables()
+        self.velocity_prior, self.velocity_table = counts.velocity_tables()
 
     def _sensor_model(self, observation, state) -> float:
         """
@@ -132,9 +502,7 @@ class touchscreenHMM:
         - The probability of observing that observation from that given state, a number.
         """
         # Write your code here!
-        # normalize the probabilities
-        #print("\n\n\n sensor model: \n\n\n" + str(self.sn_model.get(observation, {}).get(state, 0)))
-        return self.sn_model.get(observation, {}).get(state, 0)
+        return self.sensor_table[self.pos_to_index(state), self.pos_to_index(observation)]
 
     def _transition_model(self, old_state, new_state) -> float:
         """
@@ -147,10 +515,58 @@ class touchscreenHMM:
         Output:
         - The probability of transitioning from the old state to the new state, a number.
         """
-        #print("\n\n\n transition model: \n\n\n" + str(self.tr_model.get(old_state,{}).get(new_state, 0)))
-        return self.tr_model.get(old_state,{}).get(new_state, 0)
+        if old_state == (-1, -1):
+            return self.prior[self.pos_to_index(new_state)]
+        return self.transition_table[self.pos_to_index(old_state), self.pos_to_index(new_state)]
         
 
+    def use_motion_kernel(self, fft: bool = None) -> MotionKernel:
+        """
+        Switches filtering to a translation-invariant motion kernel collapsed
+        from the learned transition table, so each predict is a 2D convolution
+        of the belief grid rather than a product with the table. Worth it on
+        high-resolution screens, where the table grows with (width * height)^2.
+        Smoothing and Viterbi decoding keep using the table.
+
+        Input:
+        - fft: Whether to convolve with FFTs, see MotionKernel
+        """
+        self.hmm.motion = MotionKernel.from_tables(self.prior, self.transition_table, self.width, self.height, fft)
+        return self.hmm.motion
+
+    def use_beam(self, threshold: float = BEAM_THRESHOLD, top_k: int = None):
+        """
+        Switches filtering to pruned (beam) filtering, see HMM.use_beam.
+        """
+        self.hmm.use_beam(threshold, top_k)
+
+    def viterbi(self, max_lag: int = None) -> Viterbi:
+        """
+        Returns a Viterbi decoder over the learned tables, for the single most
+        likely path of the finger behind a stream of noisy (x, y) touches. States
+        are flat screen indices; divmod(state, height) gives back (x, y). Set
+        max_lag to bound memory on long streams, see Viterbi.
+        """
+        return Viterbi(
+            self.transition_table, self.hmm.emission, self.hmm.prior, max_lag, self.hmm.emission_cache.capacity
+        )
+
+    def smoother(self, lag: int) -> FixedLagSmoother:
+        """
+        Returns a fixed-lag smoother over the learned tables, whose estimates
+        trail the newest frame by `lag` frames in exchange for using the frames
+        that came after them.
+        """
+        return FixedLagSmoother(self, lag)
+
+    def smooth_sequence(self, observations, out=None) -> np.ndarray:
+        """
+        Returns the smoothed distribution of every frame of a whole recorded
+        sequence of noisy (x, y) touches, as a (frames x width x height) array.
+        See smoothing.forward_backward.
+        """
+        return forward_backward(self, observations, out).reshape(len(observations), self.width, self.height)
+
     def filter_noisy_data(self, frame: np.ndarray) -> np.ndarray:
         """
         This is the function we will be calling during grading, passing in a noisy simualation. It should return the
@@ -161,16 +577,173 @@ class touchscreenHMM:
         Input:
         - frame: A noisy frame to run your HMM on. This is a 2D NumPy array
                  filled with 0s, and a single 1 denoting a touch location.
+                 The (x, y) tuple of the touch location is also accepted, which
+                 skips decoding the frame.
 
         Output:
         - A 2D NumPy array with the probabilities of the actual finger location.
+          This is a view of the HMM's distribution, not a copy.
         """
         # Write your code here!
-        print(f"sum {np.sum(self.hmm.tell(self.arr_to_pos(frame)))}")
-        return self.hmm.tell(self.arr_to_pos(frame))
+        position = frame if isinstance(frame, tuple) else self.arr_to_pos(frame)
+        return self.hmm.tell(position).reshape(self.width, self.height)
+
 
 
 
+class touchscreenBatchHMM:
+    """
+    Filters K independent touch streams at once. The beliefs are held as one
+    (K x num_states) array and every tick is a single sparse predict plus a
+    vectorized update, sharing the transition and sensor tables of a trained
+    touchscreenHMM.
+    """
+
+    def __init__(self, model: "touchscreenHMM", num_streams: int):
+        """
+        Input:
+        - model:       A trained touchscreenHMM whose tables are shared
+        - num_streams: The number of independent streams K
+        """
+        self.model = model
+        self.hmm = model.hmm
+        self.width = model.width
+        self.height = model.height
+        self.num_streams = num_streams
+        self.probabilities = np.tile(self.hmm.prior, (num_streams, 1))
+
+    def reset(self, streams=None):
+        """
+        Puts the given streams (all of them by default) back to the prior.
+        """
+        if streams is None:
+            streams = slice(None)
+        self.probabilities[streams] = self.hmm.prior
+
+    def tell(self, positions: np.ndarray, streams: np.ndarray = None) -> np.ndarray:
+        """
+        Records one observation for every stream, or for some of them.
+
+        Input:
+        - positions: A (K x 2) integer array of noisy touch coordinates, or one
+                     row per stream in streams
+        - streams:   Optional distinct stream indices to update; the other
+                     streams are left as they are
+
+        Output:
+        - The filtered distributions of the updated streams, (K x num_states)
+          or one row per stream in streams
+        """
+        positions = np.asarray(positions)
+        observations = positions[:, 0] * self.height + positions[:, 1]
+        # Look every distinct observation up once, shared by the streams that saw it
+        unique_observations, inverse = np.unique(observations, return_inverse=True)
+        likelihoods = np.stack(
+            [self.hmm.emission(self.hmm.mapToState[o]) for o in unique_observations]
+        )[inverse]
+
+        predicted = self.hmm.predict(self.probabilities if streams is None else self.probabilities[streams])
+        future_probabilities, _ = self.hmm.update(predicted, likelihoods)
+        if streams is None:
+            self.probabilities = future_probabilities
+        else:
+            self.probabilities[streams] = future_probabilities
+        return future_probabilities
+
+    def filter_noisy_data(self, frames: np.ndarray) -> np.ndarray:
+        """
+        Batched version of touchscreenHMM.filter_noisy_data.
+
+        Input:
+        - frames: A (K x width x height) array of noisy frames, or a (K x 2)
+                  integer array of noisy coordinates
+
+        Output:
+        - A (K x width x height) array of distributions over the finger location
+        """
+        frames = np.asarray(frames)
+        if frames.ndim == 3:
+            flat = np.argmax(frames.reshape(len(frames), -1), axis=1)
+            frames = np.stack(np.divmod(flat, self.height), axis=1)
+        return self.tell(frames).reshape(self.num_streams, self.width, self.height)
+
+
+class touchscreenVelocityHMM:
+    """
+    Filters a touch stream over position x velocity states, so the momentum of
+    the finger informs the prediction. The velocity is the last one-frame
+    displacement in cells (see model_estimation.velocity_index), and the
+    transition is factorized: the velocity changes following the learned
+    velocity table, independently of position, then the finger moves by the
+    new velocity, stopping at the edges of the screen. Predicting costs
+    O(NUM_VELOCITIES) per state rather than a product with a table over
+    every pair of states.
+
+    The sensor model only depends on position, and is shared with the
+    trained touchscreenHMM.
+    """
+
+    def __init__(self, model: "touchscreenHMM"):
+        """
+        Input:
+        - model: A trained touchscreenHMM whose tables are shared
+        """
+        self.model = model
+        self.hmm = model.hmm
+        self.width = model.width
+        self.height = model.height
+        self.num_states = model.num_states
+        self.velocity_prior = np.asarray(model.velocity_prior, dtype=float)
+        self.velocity_table = np.asarray(model.velocity_table, dtype=float)
+
+        # shifted[v][s] is where the finger at s ends up after moving with velocity v,
+        # offset by v * num_states so one bincount moves every velocity's grid at once
+        steps = np.arange(-MAX_CELL_STEP, MAX_CELL_STEP + 1)
+        dx, dy = np.meshgrid(steps, steps, indexing="ij")
+        velocities = velocity_index(dx.ravel(), dy.ravel())
+        xs, ys = np.divmod(np.arange(self.num_states), self.height)
+        nx = np.clip(xs[None, :] + dx.ravel()[:, None], 0, self.width - 1)
+        ny = np.clip(ys[None, :] + dy.ravel()[:, None], 0, self.height - 1)
+        self.shifted = (nx * self.height + ny + velocities[:, None] * self.num_states).ravel()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets every frame, going back to the prior.
+        """
+        self.probabilities = np.outer(self.velocity_prior, self.hmm.prior)
+
+    def predict(self, probabilities: np.ndarray) -> np.ndarray:
+        """
+        Returns the (NUM_VELOCITIES x num_states) distribution one frame later.
+        """
+        accelerated = self.velocity_table.T @ probabilities
+        moved = np.bincount(self.shifted, weights=accelerated.ravel(), minlength=accelerated.size)
+        return moved.reshape(accelerated.shape)
+
+    def tell(self, observation) -> np.ndarray:
+        """
+        Records a noisy (x, y) touch.
+
+        Output:
+        - The filtered distribution over flat screen indices, with the velocity
+          summed out
+        """
+        likelihoods = self.hmm.emission(observation)
+        predicted = self.predict(self.probabilities)
+        # A lost track starts over with the velocity drawn from how often each one occurs
+        self.probabilities, _ = self.hmm.update(
+            predicted, likelihoods, restart_weights=self.velocity_prior[:, None], axis=None
+        )
+        return np.sum(self.probabilities, axis=0)
+
+    def filter_noisy_data(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Same contract as touchscreenHMM.filter_noisy_data.
+        """
+        position = frame if isinstance(frame, tuple) else self.model.arr_to_pos(frame)
+        return self.tell(position).reshape(self.width, self.height)
+
 
 if __name__ == "__main__":
     hmm = touchscreenHMM()
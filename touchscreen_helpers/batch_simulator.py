@@ -0,0 +1,215 @@
+from typing import Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .constants import MAX_ACCELERATION, MAX_SPEED, MAX_STEPS, MIN_STEPS, SCALE_FACTOR
+from .simulation_io import FRAME_DTYPE, touchscreenReplay
+
+# How each noisy reading is produced, which must sum to 1: the finger's true
+# location, a cell adjacent to it, a cell adjacent to the previous reading, the
+# previous reading again, or a random cell anywhere on the screen. The compiled
+# simulator uses the same kinds of noise, but its probabilities are hidden;
+# these are calibrated so that, as on the compiled simulator, about 32% of
+# readings land on the finger's cell.
+TRUE_LOCATION_PROBABILITY = 0.3
+ADJACENT_LOCATION_PROBABILITY = 0.28
+ADJACENT_PAST_LOCATION_PROBABILITY = 0.14
+PAST_LOCATION_PROBABILITY = 0.14
+RANDOM_LOCATION_PROBABILITY = 0.14
+NOISE_PROBABILITIES = (
+    TRUE_LOCATION_PROBABILITY,
+    ADJACENT_LOCATION_PROBABILITY,
+    ADJACENT_PAST_LOCATION_PROBABILITY,
+    PAST_LOCATION_PROBABILITY,
+    RANDOM_LOCATION_PROBABILITY,
+)
+TRUE, ADJACENT, ADJACENT_PAST, PAST, RANDOM = range(5)
+
+# The offsets of the 8 cells around a cell
+ADJACENT_OFFSETS = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy])
+
+# The compiled simulator never moves the finger more than this many cells in
+# one frame, so the finger's speed is capped at this many cells a frame as
+# well as at MAX_SPEED. It is at most model_estimation.MAX_CELL_STEP, beyond
+# which the touchscreen models drop transitions.
+MAX_CELL_MOVE = 1
+MAX_BOARD_SPEED = min(MAX_SPEED, MAX_CELL_MOVE * SCALE_FACTOR)
+
+# The number of trajectories simulate_batch_positions runs side by side
+BATCH_TRAJECTORIES = 256
+
+
+class touchscreenBatchSimulator:
+    """
+    A pure NumPy touchscreen simulator that runs many independent finger
+    trajectories at once, vectorized across the trajectories, and can be seeded.
+
+    The finger moves on a board SCALE_FACTOR times finer than the screen. It
+    keeps a random acceleration of at most MAX_ACCELERATION per axis for
+    MIN_STEPS to MAX_STEPS frames, applied SCALE_FACTOR times more slowly than
+    it moves, so it picks up speed over several frames; its speed is capped at
+    MAX_BOARD_SPEED per axis, so its cell changes by at most MAX_CELL_MOVE a
+    frame, and it bounces off the edges of the screen. Every frame is then
+    read with the noise in NOISE_PROBABILITIES.
+
+    Frames are kept as compact coordinates, a (batch x frames x 4) int16 array
+    of (noisy x, noisy y, actual x, actual y), so each trajectory is laid out
+    like simulation_io.simulation_positions and can be saved, replayed or
+    scored like any other simulation.
+    """
+
+    def __init__(
+        self,
+        width: int = 20,
+        height: int = 20,
+        frames: int = 100,
+        batch: int = 1,
+        seed: Optional[int] = None,
+        noise: Sequence[float] = NOISE_PROBABILITIES,
+    ):
+        """
+        Input:
+        - width, height: The size of the simulated screen
+        - frames:        The number of frames run_simulation generates
+        - batch:         The number of trajectories simulated together
+        - seed:          Seeds the simulation reproducibly if given
+        - noise:         The probabilities of each kind of noisy reading, in
+                         the order of NOISE_PROBABILITIES
+        """
+        if width < 1 or height < 1 or batch < 1:
+            raise ValueError("Screen dimensions and batch size must be positive integers")
+        if not np.isclose(np.sum(noise), 1):
+            raise ValueError(f"Noise probabilities sum to {np.sum(noise)}, not 1")
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.batch = batch
+        self.noise_cdf = np.cumsum(noise)
+        self.rng = np.random.default_rng(seed)
+        self.limits = np.array([width, height]) * SCALE_FACTOR - 1
+        self.positions = np.zeros((batch, 0, 4), dtype=FRAME_DTYPE)
+        self.reset()
+
+    def reset(self):
+        """
+        Starts every trajectory again from rest at a random point.
+        """
+        self.location = self.rng.integers(0, self.limits + 1, size=(self.batch, 2)).astype(float)
+        self.velocity = np.zeros((self.batch, 2))
+        self.acceleration = np.zeros((self.batch, 2))
+        self.remaining_steps = np.zeros(self.batch, dtype=np.int64)
+        self.cell = (self.location // SCALE_FACTOR).astype(np.int64)
+        self.reading = None
+
+    def adjacent(self, cells: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        """
+        Moves each cell one step in a direction, stepping the other way along
+        any axis that would leave the screen.
+        """
+        offsets = ADJACENT_OFFSETS[directions]
+        moved = cells + offsets
+        off = (moved < 0) | (moved >= (self.width, self.height))
+        moved[off] = (cells - offsets)[off]
+        return np.clip(moved, 0, [self.width - 1, self.height - 1])
+
+    def step(self, frames: int) -> np.ndarray:
+        """
+        Continues every trajectory for a number of frames.
+
+        Output:
+        - A (batch x frames x 4) array of (noisy x, noisy y, actual x, actual y)
+        """
+        out = np.empty((self.batch, frames, 4), dtype=FRAME_DTYPE)
+        rng = self.rng
+        # Everything random is drawn up front, one array per kind of draw
+        accelerations = rng.integers(-MAX_ACCELERATION, MAX_ACCELERATION + 1, size=(frames, self.batch, 2))
+        durations = rng.integers(MIN_STEPS, MAX_STEPS + 1, size=(frames, self.batch))
+        kinds = np.minimum(np.searchsorted(self.noise_cdf, rng.random((frames, self.batch)), side="right"), RANDOM)
+        directions = rng.integers(len(ADJACENT_OFFSETS), size=(frames, self.batch))
+        random_cells = rng.integers(0, (self.width, self.height), size=(frames, self.batch, 2))
+
+        for t in range(frames):
+            renew = self.remaining_steps == 0
+            self.acceleration[renew] = accelerations[t, renew]
+            self.remaining_steps[renew] = durations[t, renew]
+            self.remaining_steps -= 1
+            np.clip(self.velocity + self.acceleration / SCALE_FACTOR, -MAX_BOARD_SPEED, MAX_BOARD_SPEED, out=self.velocity)
+            self.location += self.velocity
+            # Bounce off the edges: reverse the direction and stop on the edge
+            off = (self.location < 0) | (self.location > self.limits)
+            self.velocity[off] *= -1
+            self.acceleration[off] *= -1
+            np.clip(self.location, 0, self.limits, out=self.location)
+            # Rounding the location can carry it across one cell boundary too many
+            cell = (self.location // SCALE_FACTOR).astype(np.int64)
+            actual = self.cell = np.clip(cell, self.cell - MAX_CELL_MOVE, self.cell + MAX_CELL_MOVE)
+
+            # The first reading has no past reading to fall back on
+            past = actual if self.reading is None else self.reading
+            kind = kinds[t, :, None]
+            reading = np.where(kind == TRUE, actual, random_cells[t])
+            reading = np.where(kind == ADJACENT, self.adjacent(actual, directions[t]), reading)
+            reading = np.where(kind == ADJACENT_PAST, self.adjacent(past, directions[t]), reading)
+            self.reading = np.where(kind == PAST, past, reading)
+            out[:, t, :2] = self.reading
+            out[:, t, 2:] = actual
+        return out
+
+    def run_simulation(self):
+        """
+        Simulates frames new frames of every trajectory, from the start.
+        """
+        self.reset()
+        self.positions = self.step(self.frames)
+
+    def replay(self, index: int = 0) -> touchscreenReplay:
+        """
+        Plays back one simulated trajectory, for the evaluator or anything
+        else that reads from a touchscreenSimulator.
+        """
+        return touchscreenReplay(self.width, self.height, self.positions[index])
+
+
+def simulate_batch_positions(
+    width: int,
+    height: int,
+    frames: int,
+    chunk_frames: int,
+    batch: int = BATCH_TRAJECTORIES,
+    seed: Optional[int] = None,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    The touchscreenBatchSimulator counterpart of model_estimation.simulate_positions:
+    runs batch trajectories side by side, continuing them from chunk to chunk,
+    and yields their frames as flat screen indices (x * height + y).
+
+    Input:
+    - width, height: The size of the simulated screen
+    - frames:        The total number of frames to simulate, across every trajectory
+    - chunk_frames:  The number of frames in each chunk, across every trajectory
+    - batch:         The number of trajectories
+    - seed:          Seeds the simulation reproducibly if given
+
+    Output:
+    - An iterator of (noisy, actual) integer arrays, each (trajectories x frames),
+      with one row per trajectory
+    """
+    batch = max(1, min(batch, frames, chunk_frames))
+    simulator = touchscreenBatchSimulator(width, height, 0, batch, seed)
+    length = -(-frames // batch)
+    step = max(1, chunk_frames // batch)
+    for start in range(0, length, step):
+        positions = simulator.step(min(step, length - start)).astype(np.int64)
+        noisy = positions[:, :, 0] * height + positions[:, :, 1]
+        actual = positions[:, :, 2] * height + positions[:, :, 3]
+        # The last trajectories stop early when frames doesn't divide evenly
+        remaining = frames - start * batch
+        if remaining < noisy.size:
+            rows = remaining // noisy.shape[1]
+            if rows:
+                yield noisy[:rows], actual[:rows]
+            leftover = remaining - rows * noisy.shape[1]
+            if leftover:
+                yield noisy[rows:rows + 1, :leftover], actual[rows:rows + 1, :leftover]
+            return
+        yield noisy, actual
@@ -0,0 +1,262 @@
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from .batch_simulator import simulate_batch_positions
+from .constants import MAX_SPEED, SCALE_FACTOR
+from .simulator import touchscreenSimulator
+
+# How many frames are decoded and counted at a time while training
+CHUNK_FRAMES = 65536
+
+# The furthest the finger can move between two frames, in screen cells. The
+# simulator moves at most MAX_SPEED on a board scaled up by SCALE_FACTOR, so
+# every other transition has zero probability.
+MAX_CELL_STEP = -(-MAX_SPEED // SCALE_FACTOR)
+# The number of distinct one-frame displacements (dx, dy) of at most MAX_CELL_STEP cells
+NUM_VELOCITIES = (2 * MAX_CELL_STEP + 1) ** 2
+
+
+def velocity_index(dx: np.ndarray, dy: np.ndarray) -> np.ndarray:
+    """
+    Maps displacements in cells, clipped to MAX_CELL_STEP, to velocity indices
+    (dx + MAX_CELL_STEP) * (2 * MAX_CELL_STEP + 1) + (dy + MAX_CELL_STEP).
+    """
+    dx = np.clip(dx, -MAX_CELL_STEP, MAX_CELL_STEP) + MAX_CELL_STEP
+    dy = np.clip(dy, -MAX_CELL_STEP, MAX_CELL_STEP) + MAX_CELL_STEP
+    return dx * (2 * MAX_CELL_STEP + 1) + dy
+
+
+def simulate_positions(
+    width: int, height: int, frames: int, chunk_frames: int = CHUNK_FRAMES
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Runs touchscreenSimulators and yields their frames in chunks of flat screen
+    indices (x * height + y). The simulator keeps every frame it generates as
+    a dense screen, so each chunk comes from a fresh simulation of its own and
+    at most chunk_frames dense frames are ever held; consecutive chunks are
+    independent trajectories.
+
+    Input:
+    - width, height: The size of the simulated screen
+    - frames:        The number of frames to simulate
+    - chunk_frames:  The number of frames in each chunk
+
+    Output:
+    - An iterator of (noisy, actual) integer arrays, each at most chunk_frames long
+    """
+    noisy = np.empty(chunk_frames, dtype=np.int64)
+    actual = np.empty(chunk_frames, dtype=np.int64)
+    for start in range(0, frames, chunk_frames):
+        size = min(chunk_frames, frames - start)
+        sim = touchscreenSimulator(width=width, height=height, frames=size)
+        sim.run_simulation()
+        for i in range(size):
+            noisy_frame, actual_frame = sim.get_frame(actual_position=True)
+            noisy[i] = np.argmax(noisy_frame)
+            actual[i] = np.argmax(actual_frame)
+        del sim
+        yield noisy[:size], actual[:size]
+
+
+class touchscreenCounts:
+    """
+    Running counts for learning the touchscreen model: how often each state is
+    occupied, each transition between states is taken and each observation is
+    seen from each state. Counts are kept as flat arrays and sparse matrices
+    indexed by flat screen index, so they can be added to chunk by chunk.
+
+    How often each velocity (one-frame displacement, see velocity_index) is
+    followed by each other is counted as well, for the velocity-augmented model.
+    """
+
+    def __init__(self, width: int, height: int, dtype=np.int64):
+        """
+        Input:
+        - width, height: The size of the screen
+        - dtype:         np.int64 for counted frames, or a float type for expected
+                         counts such as those of Baum-Welch
+        """
+        self.width = width
+        self.height = height
+        self.num_states = width * height
+        shape = (self.num_states, self.num_states)
+        self.occupancy = np.zeros(self.num_states, dtype=dtype)
+        self.transitions = sparse.csr_matrix(shape, dtype=dtype)
+        self.sensor = sparse.csr_matrix(shape, dtype=dtype)
+        self.velocities = np.zeros((NUM_VELOCITIES, NUM_VELOCITIES), dtype=dtype)
+        # How often each state comes before the first frame of a sequence, only
+        # counted by Baum-Welch, whose prior is the distribution of that state
+        self.initial = np.zeros(self.num_states, dtype=dtype)
+        # The last actual state and velocity of the previous chunk, so transitions carry across chunks
+        self.last_state = None
+        self.last_velocity = None
+
+    def _pair_counts(self, rows: np.ndarray, cols: np.ndarray) -> sparse.csr_matrix:
+        keys, counts = np.unique(rows * self.num_states + cols, return_counts=True)
+        return sparse.csr_matrix(
+            (counts, np.divmod(keys, self.num_states)), shape=(self.num_states, self.num_states)
+        )
+
+    def add(self, noisy: np.ndarray, actual: np.ndarray):
+        """
+        Counts one chunk of consecutive frames, continuing the chunk added
+        before it: the transition into its first frame is counted too.
+
+        Input:
+        - noisy:  The observed flat screen indices, an integer array
+        - actual: The true flat screen indices, an integer array of the same length
+        """
+        if len(actual) == 0:
+            return
+        self.occupancy += np.bincount(actual, minlength=self.num_states)
+        self.sensor += self._pair_counts(actual, noisy)
+        previous = actual[:-1] if self.last_state is None else np.concatenate(([self.last_state], actual[:-1]))
+        current = actual[1:] if self.last_state is None else actual
+        self.transitions += self._pair_counts(previous, current)
+
+        previous_x, previous_y = np.divmod(previous, self.height)
+        current_x, current_y = np.divmod(current, self.height)
+        velocities = velocity_index(current_x - previous_x, current_y - previous_y)
+        if self.last_velocity is not None:
+            velocities = np.concatenate(([self.last_velocity], velocities))
+        pairs = velocities[:-1] * NUM_VELOCITIES + velocities[1:]
+        self.velocities += np.bincount(pairs, minlength=NUM_VELOCITIES ** 2).reshape(self.velocities.shape)
+        self.last_state = actual[-1]
+        if len(velocities):
+            self.last_velocity = velocities[-1]
+
+    def add_batch(self, noisy: np.ndarray, actual: np.ndarray):
+        """
+        Counts the frames of several independent trajectories, such as a chunk
+        of simulate_batch_positions. Transitions are only counted within a
+        trajectory, and not between chunks.
+
+        Input:
+        - noisy:  The observed flat screen indices, a (trajectories x frames) integer array
+        - actual: The true flat screen indices, an array of the same shape
+        """
+        if actual.size == 0:
+            return
+        self.occupancy += np.bincount(actual.ravel(), minlength=self.num_states)
+        self.sensor += self._pair_counts(actual.ravel(), noisy.ravel())
+        self.transitions += self._pair_counts(actual[:, :-1].ravel(), actual[:, 1:].ravel())
+
+        x, y = np.divmod(actual, self.height)
+        velocities = velocity_index(np.diff(x, axis=1), np.diff(y, axis=1))
+        pairs = velocities[:, :-1] * NUM_VELOCITIES + velocities[:, 1:]
+        self.velocities += np.bincount(pairs.ravel(), minlength=NUM_VELOCITIES ** 2).reshape(self.velocities.shape)
+
+    def merge(self, other: "touchscreenCounts"):
+        """
+        Adds the counts from an independent run on the same screen size.
+        """
+        self.occupancy += other.occupancy
+        self.transitions += other.transitions
+        self.sensor += other.sensor
+        self.velocities += other.velocities
+        self.initial += other.initial
+
+    def tables(self) -> Tuple[np.ndarray, sparse.csc_matrix, sparse.csc_matrix]:
+        """
+        Normalizes the counts into the touchscreen model tables.
+
+        Output:
+        - prior:      How often each state is occupied, normalized
+        - transition: transition[s][s'] = P(s' | s), a CSC matrix
+        - sensor:     sensor[s][o] = P(o | s), a CSC matrix
+        States that were never visited get all-zero rows.
+        """
+        prior = self.occupancy / max(np.sum(self.occupancy), 1)
+        return prior, self._normalize_rows(self.transitions), self._normalize_rows(self.sensor)
+
+    def velocity_tables(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Normalizes the velocity counts.
+
+        Output:
+        - velocity_prior:      How often each velocity occurs, normalized
+        - velocity_transition: velocity_transition[v][v'] = P(v' | v), a dense
+          (NUM_VELOCITIES x NUM_VELOCITIES) array. Velocities never seen stay put.
+        """
+        totals = np.sum(self.velocities, axis=1).astype(float)
+        velocity_prior = totals / max(np.sum(totals), 1)
+        unseen = totals == 0
+        totals[unseen] = 1
+        velocity_transition = self.velocities / totals[:, None]
+        velocity_transition[unseen, unseen] = 1
+        return velocity_prior, velocity_transition
+
+    def _normalize_rows(self, counts: sparse.csr_matrix) -> sparse.csc_matrix:
+        totals = np.asarray(counts.sum(axis=1)).ravel().astype(float)
+        totals[totals == 0] = 1
+        return sparse.csc_matrix(sparse.diags(1 / totals) @ counts)
+
+
+def count_simulation(
+    width: int, height: int, frames: int, seed: Optional[int] = None, simulator: str = "compiled"
+) -> touchscreenCounts:
+    """
+    Counts one independent simulation. Runs in a worker process when training
+    in parallel, so the random generators are seeded first: forked workers
+    would otherwise all replay the parent's random state.
+
+    With simulator="numpy", the frames come from touchscreenBatchSimulator
+    trajectories instead of the compiled touchscreenSimulator.
+    """
+    counts = touchscreenCounts(width, height)
+    if simulator == "numpy":
+        for noisy, actual in simulate_batch_positions(width, height, frames, CHUNK_FRAMES, seed=seed):
+            counts.add_batch(noisy, actual)
+        return counts
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    for noisy, actual in simulate_positions(width, height, frames):
+        # Each chunk is its own trajectory, so no transition joins two chunks
+        counts.add_batch(noisy[None], actual[None])
+    return counts
+
+
+def parallel_counts(
+    width: int,
+    height: int,
+    frames: int,
+    workers: Optional[int] = None,
+    seed: Optional[int] = None,
+    simulator: str = "compiled",
+) -> touchscreenCounts:
+    """
+    Splits the training frames across independent, differently seeded
+    simulations run in a process pool, and merges the counts they send back.
+
+    Input:
+    - width, height: The size of the simulated screen
+    - frames:        The total number of frames to simulate
+    - workers:       The number of processes, os.cpu_count() by default
+    - seed:          Seeds the simulations reproducibly if given
+    - simulator:     "compiled" or "numpy", see count_simulation
+
+    Output:
+    - The merged touchscreenCounts
+    """
+    workers = workers or os.cpu_count() or 1
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    seeds = np.random.SeedSequence(seed).generate_state(workers)
+    shares = [frames // workers + (i < frames % workers) for i in range(workers)]
+
+    counts = touchscreenCounts(width, height)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(count_simulation, width, height, share, int(worker_seed), simulator)
+            for share, worker_seed in zip(shares, seeds)
+            if share > 0
+        ]
+        for future in futures:
+            counts.merge(future.result())
+    return counts
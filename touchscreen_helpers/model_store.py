@@ -0,0 +1,221 @@
+import json
+import os
+from multiprocessing import shared_memory
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+# Bump whenever the layout of a saved model changes; older files are ignored
+FORMAT_VERSION = 2
+MAGIC = b"TSHMMTAB"
+# Arrays start on 64-byte boundaries so that memory-mapped views are aligned
+ALIGNMENT = 64
+
+# Where trained models are cached unless TOUCHSCREEN_MODEL_CACHE says otherwise
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "model_cache")
+
+
+def artifact_path(
+    width: int, height: int, frames: int, cache_dir: Optional[str] = None, simulator: str = "compiled"
+) -> str:
+    """
+    Returns the file a model trained on a width x height screen with the given
+    number of frames from the given simulator is cached in.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("TOUCHSCREEN_MODEL_CACHE", DEFAULT_CACHE_DIR)
+    source = "" if simulator == "compiled" else f"_{simulator}"
+    return os.path.join(cache_dir, f"touchscreen_{width}x{height}_{frames}{source}.v{FORMAT_VERSION}.tables")
+
+
+def data_start(header_length: int) -> int:
+    """
+    Data starts at the first aligned offset after the magic bytes, the format
+    version, the header length and the header.
+    """
+    return -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+
+def pack_tables(arrays: Dict[str, np.ndarray], metadata: dict):
+    """
+    Lays named arrays out for save_tables and SharedTables.
+
+    Output:
+    - (contiguous arrays, layout by name, preamble bytes, data start, total size)
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({"metadata": metadata, "arrays": layout}).encode()
+    preamble = MAGIC + np.array([FORMAT_VERSION, len(header)], dtype="<u4").tobytes() + header
+    start = data_start(len(header))
+    return arrays, layout, preamble, start, start + offset
+
+
+def save_tables(path: str, arrays: Dict[str, np.ndarray], metadata: dict) -> None:
+    """
+    Writes named arrays to a single binary file: the magic bytes, the format
+    version, a JSON header describing each array, then the raw (aligned) array
+    data. The file is written under a temporary name and moved into place, so
+    concurrent readers never see a partial model.
+
+    Input:
+    - path:     Where to write the tables
+    - arrays:   The arrays to store, by name
+    - metadata: Extra JSON-serializable information to store in the header
+    """
+    arrays, layout, preamble, start, size = pack_tables(arrays, metadata)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(preamble)
+        for name, array in arrays.items():
+            f.seek(start + layout[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(size)
+    os.replace(temporary_path, path)
+
+
+def load_tables(path: str) -> Optional[Tuple[Dict[str, np.ndarray], dict]]:
+    """
+    Memory-maps the arrays in a file written by save_tables. The arrays are
+    read-only views of the file, so processes loading the same model share
+    its pages.
+
+    Input:
+    - path: The file to load
+
+    Output:
+    - (arrays by name, metadata), or None if the file is missing or was
+      written in a different format version
+    """
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            version, header_length = np.frombuffer(f.read(8), dtype="<u4")
+            header = json.loads(f.read(header_length))
+    except (OSError, ValueError):
+        return None
+    if magic != MAGIC or version != FORMAT_VERSION:
+        return None
+
+    start = data_start(int(header_length))
+    arrays = {}
+    for name, layout in header["arrays"].items():
+        shape = tuple(layout["shape"])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=layout["dtype"])
+            continue
+        arrays[name] = np.memmap(
+            path, dtype=layout["dtype"], mode="r", offset=start + layout["offset"], shape=shape
+        )
+    return arrays, header["metadata"]
+
+
+class SharedTables:
+    """
+    Named arrays in a multiprocessing.shared_memory block, laid out exactly
+    like a file from save_tables. One process publishes the tables; others
+    attach to them by name and get read-only NumPy views of the same pages,
+    with no copying or unpickling, so memory stays flat however many workers
+    attach.
+
+    The views are only valid while the SharedTables they came from is alive.
+    The publisher should unlink the block once every worker is done with it.
+    """
+
+    def __init__(self, memory: shared_memory.SharedMemory, owner: bool):
+        self.memory = memory
+        self.owner = owner
+        self.name = memory.name
+        buffer = memory.buf
+        magic = bytes(buffer[: len(MAGIC)])
+        version, header_length = np.frombuffer(buffer, dtype="<u4", count=2, offset=len(MAGIC))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"shared memory {memory.name} does not hold model tables of version {FORMAT_VERSION}")
+        header_start = len(MAGIC) + 8
+        header = json.loads(bytes(buffer[header_start:header_start + int(header_length)]))
+        start = data_start(int(header_length))
+
+        self.metadata = header["metadata"]
+        self.arrays = {}
+        for name, layout in header["arrays"].items():
+            shape = tuple(layout["shape"])
+            if np.prod(shape) == 0:
+                self.arrays[name] = np.zeros(shape, dtype=layout["dtype"])
+                continue
+            array = np.ndarray(shape, dtype=layout["dtype"], buffer=buffer, offset=start + layout["offset"])
+            array.flags.writeable = False
+            self.arrays[name] = array
+
+    @classmethod
+    def publish(cls, arrays: Dict[str, np.ndarray], metadata: dict) -> "SharedTables":
+        """
+        Copies named arrays into a new shared memory block.
+        """
+        arrays, layout, preamble, start, size = pack_tables(arrays, metadata)
+        memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        memory.buf[: len(preamble)] = preamble
+        for name, array in arrays.items():
+            if array.size:
+                view = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf, offset=start + layout[name]["offset"])
+                view[...] = array
+                del view
+        return cls(memory, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedTables":
+        """
+        Attaches to tables published by this process or the process that started it.
+        """
+        try:
+            memory = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching always registers the block with the
+            # resource tracker. Worker processes share the publisher's tracker,
+            # which only cleans up blocks left over when the publisher exits.
+            memory = shared_memory.SharedMemory(name=name)
+        return cls(memory, owner=False)
+
+    def close(self):
+        """
+        Drops the views and detaches; the publisher also unlinks the block.
+        """
+        self.arrays = {}
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def __enter__(self) -> "SharedTables":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def sparse_to_arrays(name: str, matrix: sparse.spmatrix) -> Dict[str, np.ndarray]:
+    """
+    Splits a sparse matrix into the arrays of its CSC representation, named
+    name_data, name_indices and name_indptr.
+    """
+    matrix = sparse.csc_matrix(matrix)
+    return {
+        f"{name}_data": matrix.data,
+        f"{name}_indices": matrix.indices,
+        f"{name}_indptr": matrix.indptr,
+    }
+
+
+def arrays_to_sparse(arrays: Dict[str, np.ndarray], name: str, shape: Tuple[int, int]) -> sparse.csc_matrix:
+    """
+    Rebuilds a CSC matrix saved with sparse_to_arrays without copying its arrays.
+    """
+    return sparse.csc_matrix(
+        (arrays[f"{name}_data"], arrays[f"{name}_indices"], arrays[f"{name}_indptr"]),
+        shape=shape,
+        copy=False,
+    )
@@ -3,10 +3,17 @@ import numpy as np
 from math import sqrt
 from scipy.stats import norm
 
+# The most frames evaluate_touchscreen_hmm_positions filters before scoring them together
+SCORE_CHUNK_FRAMES = 4096
+# The most memory those buffered frames may take, in bytes; large screens buffer fewer frames
+SCORE_CHUNK_BYTES = 64 * 1024 * 1024
+
 
 class touchscreenEvaluator:
     def __init__(self):
         self.past_distributions = {}
+        # calc_distribution_score weights by (width, height), see distance_kernel
+        self.kernels = {}
 
     def calc_score(self, actual_frame, estimated_frame):
         """
@@ -19,15 +26,15 @@ class touchscreenEvaluator:
         n = len(actual_frame) * len(actual_frame[0])
         actual = np.reshape(actual_frame, n)
         estimated = np.reshape(estimated_frame, n)
-        total = sum(estimated)
-        if any(estimated < -0.001) or total > 1.001 or total < 0.999:
+        total = np.sum(estimated)
+        if np.any(estimated < -0.001) or total > 1.001 or total < 0.999:
             print("Estimated frame is not a probability distribution!")
             return 0
 
         return (1 + 2 * np.dot(actual, estimated) - np.dot(estimated, estimated)) / 2.0
 
     def calc_consistency_score(self, actual_frame, estimated_frame):
-        actual_loc = np.asarray(np.where(actual_frame == 1)).T.tolist()[0]
+        actual_loc = divmod(int(np.argmax(actual_frame)), len(actual_frame[0]))
         if estimated_frame[actual_loc[0]][actual_loc[1]] > (1 / 400):
             return True
         else:
@@ -80,6 +87,93 @@ class touchscreenEvaluator:
                 score += math.pow(0.5 - 2 * (dist / n), 3) * student_frame[i][j]
         return multipler * score
 
+    def distance_kernel(self, width, height):
+        """
+        The calc_distribution_score weight of every offset from the actual finger
+        location, computed once per screen size:
+           kernel[dx + width - 1][dy + height - 1] = (0.5 - 2 * max(|dx|, |dy|) / width)^3
+        The weights around an actual location (x, y) are the width x height window
+        of the kernel starting at (width - 1 - x, height - 1 - y).
+        """
+        kernel = self.kernels.get((width, height))
+        if kernel is None:
+            dx = np.abs(np.arange(-(width - 1), width))[:, None]
+            dy = np.abs(np.arange(-(height - 1), height))[None, :]
+            kernel = np.power(0.5 - 2 * (np.maximum(dx, dy) / width), 3)
+            self.kernels[(width, height)] = kernel
+        return kernel
+
+    def calc_distribution_scores(self, noisy_locs, actual_locs, student_frames):
+        """
+        calc_distribution_score for a whole run at once.
+
+        Inputs:
+           noisy_locs: (T x 2) integer array of noisy finger locations
+           actual_locs: (T x 2) integer array of actual finger locations
+           student_frames: (T x width x height) array of the student's distributions
+
+        Outputs:
+           A length T array of frame scores
+        """
+        noisy_locs = np.asarray(noisy_locs)
+        actual_locs = np.asarray(actual_locs)
+        _, width, height = student_frames.shape
+        windows = np.lib.stride_tricks.sliding_window_view(self.distance_kernel(width, height), (width, height))
+        weights = windows[width - 1 - actual_locs[:, 0], height - 1 - actual_locs[:, 1]]
+        multiplier = np.max(np.abs(noisy_locs - actual_locs), axis=1) / (2 * width) + 1
+        return multiplier * np.einsum("tij,tij->t", weights, student_frames)
+
+    def calc_scores(self, actual_locs, student_frames):
+        """
+        calc_score for a whole run at once, with the actual finger locations as a
+        (T x 2) integer array. Frames that are not probability distributions score 0.
+        """
+        actual_locs = np.asarray(actual_locs)
+        estimated = student_frames.reshape(len(student_frames), -1)
+        totals = np.sum(estimated, axis=1)
+        valid = ~np.any(estimated < -0.001, axis=1) & (totals <= 1.001) & (totals >= 0.999)
+        if not np.all(valid):
+            print(f"{np.sum(~valid)} estimated frames are not probability distributions!")
+        at_actual = student_frames[np.arange(len(student_frames)), actual_locs[:, 0], actual_locs[:, 1]]
+        scores = (1 + 2 * at_actual - np.einsum("ti,ti->t", estimated, estimated)) / 2.0
+        return np.where(valid, scores, 0)
+
+    def calc_consistency_scores(self, actual_locs, student_frames):
+        """
+        calc_consistency_score for a whole run at once, as a boolean array.
+        """
+        actual_locs = np.asarray(actual_locs)
+        return student_frames[np.arange(len(student_frames)), actual_locs[:, 0], actual_locs[:, 1]] > (1 / 400)
+
+    def score_run(self, noisy_locs, actual_locs, student_frames):
+        """
+        Scores a whole run in one pass, giving the same rubric as evaluate_touchscreen_hmm.
+
+        Inputs:
+           noisy_locs: (T x 2) integer array of noisy finger locations
+           actual_locs: (T x 2) integer array of actual finger locations
+           student_frames: (T x width x height) array of the student's distributions
+        """
+        self.missed = 0
+        self.noisy_missed = 0
+        totals = self._add_scores((0, 0, 0), noisy_locs, actual_locs, student_frames)
+        return self.summarize(*totals)
+
+    def _add_scores(self, totals, noisy_locs, actual_locs, student_frames):
+        """
+        Adds a chunk of frames to the running (score, noisy_score, actual) totals and
+        missed frame counts. cumsum adds the frame scores one after another, as the
+        frame-by-frame loop does, so the totals come out exactly the same.
+        """
+        noisy_locs = np.asarray(noisy_locs)
+        actual_locs = np.asarray(actual_locs)
+        score, noisy_score, actual = totals
+        matches = np.all(noisy_locs == actual_locs, axis=1)
+        score = np.cumsum(np.concatenate(([score], self.calc_scores(actual_locs, student_frames))))[-1]
+        self.missed += int(np.sum(~self.calc_consistency_scores(actual_locs, student_frames)))
+        self.noisy_missed += int(np.sum(~matches))
+        return score, noisy_score + int(np.sum(matches)), actual + len(actual_locs)
+
     def evaluate_consistency(self):
         return self.missed
 
@@ -108,6 +202,8 @@ class touchscreenEvaluator:
         accuracy' of just inputting the noisy location.
         """
         print("Evaluating student touchscreenHMM.")
+        if hasattr(simulation, "get_position"):
+            return self.evaluate_touchscreen_hmm_positions(touchscreenHMM, simulation)
         score = 0
         noisy_score = 0
         actual = 0
@@ -128,6 +224,55 @@ class touchscreenEvaluator:
                 self.noisy_missed += 1
 
             frame = simulation.get_frame(actual_position=True)
+        return self.summarize(score, noisy_score, actual)
+
+    def evaluate_touchscreen_hmm_positions(self, touchscreenHMM, simulation):
+        """
+        evaluate_touchscreen_hmm for simulations that hand out coordinates
+        (see simulation_io.touchscreenReplay): frames are passed to the student's
+        HMM as (x, y) tuples, and the results are scored in chunks with score_run's
+        vectorized scoring instead of frame by frame.
+        """
+        return self.summarize(*self.replay_totals(touchscreenHMM, simulation))
+
+    def replay_totals(self, touchscreenHMM, simulation):
+        """
+        Plays a coordinate simulation through the student's HMM and returns the
+        summed (score, noisy_score, actual), leaving the missed frame counts in
+        self.missed and self.noisy_missed, so that several runs can be added up
+        before summarizing.
+        """
+        self.missed = 0
+        self.noisy_missed = 0
+        totals = (0, 0, 0)
+        student_frames = None
+        count = 0
+        position = simulation.get_position(actual_position=True)
+        while position:
+            noisy_loc, actual_loc = position
+            student_frame = touchscreenHMM.filter_noisy_data(noisy_loc)
+            if student_frames is None:
+                frame_bytes = np.size(student_frame) * np.dtype(float).itemsize
+                chunk_frames = max(1, min(SCORE_CHUNK_FRAMES, SCORE_CHUNK_BYTES // frame_bytes))
+                student_frames = np.empty((chunk_frames,) + np.shape(student_frame))
+                noisy_locs = np.empty((chunk_frames, 2), dtype=int)
+                actual_locs = np.empty((chunk_frames, 2), dtype=int)
+            student_frames[count] = student_frame
+            noisy_locs[count] = noisy_loc
+            actual_locs[count] = actual_loc
+            count += 1
+            if count == chunk_frames:
+                totals = self._add_scores(totals, noisy_locs, actual_locs, student_frames)
+                count = 0
+            position = simulation.get_position(actual_position=True)
+        if count:
+            totals = self._add_scores(totals, noisy_locs[:count], actual_locs[:count], student_frames[:count])
+        return totals
+
+    def summarize(self, score, noisy_score, actual):
+        """
+        Turns the summed frame scores and the missed frame counts into the rubric.
+        """
         acc_score = round(self.scale_score(score / actual), 3)
         noisy_score = round(self.scale_score(noisy_score / actual), 3)
         rubric1 = (acc_score - noisy_score) / (100 - noisy_score)
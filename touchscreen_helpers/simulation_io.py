@@ -0,0 +1,162 @@
+from typing import Tuple
+
+import numpy as np
+
+# Binary simulations start with these bytes, followed by the format version,
+# width, height and frame count as little-endian int32s and then a (frames x 4)
+# little-endian int16 array of (noisy x, noisy y, actual x, actual y).
+MAGIC = b"TSSIMBIN"
+FORMAT_VERSION = 1
+HEADER_BYTES = len(MAGIC) + 4 * 4
+FRAME_DTYPE = np.dtype("<i2")
+
+
+def simulation_positions(simulator) -> np.ndarray:
+    """
+    Reads every remaining frame of a simulator as coordinates and rewinds it.
+
+    Input:
+    - simulator: A touchscreenSimulator that has been run or loaded
+
+    Output:
+    - A (frames x 4) int16 array of (noisy x, noisy y, actual x, actual y)
+    """
+    positions = np.empty((simulator.frames, 4), dtype=FRAME_DTYPE)
+    count = 0
+    for (noisy, actual) in iter(lambda: simulator.get_frame(actual_position=True), None):
+        positions[count, :2] = np.divmod(np.argmax(noisy), noisy.shape[1])
+        positions[count, 2:] = np.divmod(np.argmax(actual), actual.shape[1])
+        count += 1
+    simulator.timestamp = 0
+    return positions[:count]
+
+
+def is_binary_simulation(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_simulation(path: str, width: int, height: int, positions: np.ndarray, binary: bool = True):
+    """
+    Writes simulated coordinates in one go, either in the binary format or as
+    the text format (a "width height frames" line, then one frame per line).
+
+    Input:
+    - path:          Where to save the simulation
+    - width, height: The size of the simulated screen
+    - positions:     A (frames x 4) array from simulation_positions
+    - binary:        Whether to use the binary format instead of text
+    """
+    if binary:
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(np.array([FORMAT_VERSION, width, height, len(positions)], dtype="<i4").tobytes())
+            np.ascontiguousarray(positions, dtype=FRAME_DTYPE).tofile(f)
+    else:
+        with open(path, "w") as f:
+            f.write("%d %d %d\n" % (width, height, len(positions)))
+            np.savetxt(f, positions, fmt="%i")
+
+
+def read_simulation_header(path: str) -> Tuple[int, int, int]:
+    """
+    Reads the (width, height, frames) of a saved simulation in either format
+    without loading its frames.
+    """
+    if not is_binary_simulation(path):
+        with open(path, "r") as f:
+            width, height, frames = [int(x) for x in f.readline().strip().split(" ")]
+        return width, height, frames
+    with open(path, "rb") as f:
+        f.seek(len(MAGIC))
+        version, width, height, frames = np.frombuffer(f.read(16), dtype="<i4")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} is simulation format version {version}, expected {FORMAT_VERSION}")
+    return int(width), int(height), int(frames)
+
+
+def load_simulation(path: str) -> Tuple[int, int, np.ndarray]:
+    """
+    Reads a simulation saved in either format. Binary files are memory-mapped,
+    so the coordinates are only read from disk as they are used.
+
+    Input:
+    - path: The saved simulation
+
+    Output:
+    - (width, height, positions), positions being a (frames x 4) integer array
+    """
+    if not is_binary_simulation(path):
+        with open(path, "r") as f:
+            width, height, frames = [int(x) for x in f.readline().strip().split(" ")]
+            if frames == 0:
+                return width, height, np.zeros((0, 4), dtype=int)
+            positions = np.loadtxt(f, dtype="int", ndmin=2)
+        return width, height, positions
+
+    width, height, frames = read_simulation_header(path)
+    if frames == 0:
+        return width, height, np.zeros((0, 4), dtype=FRAME_DTYPE)
+    positions = np.memmap(path, dtype=FRAME_DTYPE, mode="r", offset=HEADER_BYTES, shape=(frames, 4))
+    return width, height, positions
+
+
+class touchscreenReplay:
+    """
+    Plays back simulated coordinates. It has the same get_frame interface as
+    touchscreenSimulator, plus get_position, which hands out the coordinates
+    directly instead of building and scanning a dense frame for each one.
+    """
+
+    def __init__(self, width: int, height: int, positions: np.ndarray):
+        """
+        Input:
+        - width, height: The size of the simulated screen
+        - positions:     A (frames x 4) array of (noisy x, noisy y, actual x, actual y)
+        """
+        self.width = width
+        self.height = height
+        self.positions = positions
+        self.frames = len(positions)
+        self.timestamp = 0
+
+    @classmethod
+    def from_simulator(cls, simulator) -> "touchscreenReplay":
+        return cls(simulator.width, simulator.height, simulation_positions(simulator))
+
+    @classmethod
+    def from_file(cls, path: str) -> "touchscreenReplay":
+        return cls(*load_simulation(path))
+
+    def get_position(self, actual_position: bool = False):
+        """
+        Gets the next frame as coordinates
+        Input:
+        - actual_position: If True, also returns the actual position of the finger
+        Output:
+        - The noisy (x, y) or a tuple of the noisy and actual (x, y), or None
+          once every frame has been played
+        """
+        if self.timestamp >= self.frames:
+            return None
+        nx, ny, ax, ay = self.positions[self.timestamp].tolist()
+        self.timestamp += 1
+        if actual_position:
+            return (nx, ny), (ax, ay)
+        return nx, ny
+
+    def convert_coordinate_to_screen(self, x: int, y: int) -> np.ndarray:
+        screen = np.zeros((self.width, self.height))
+        screen[x, y] = 1
+        return screen
+
+    def get_frame(self, actual_position: bool = False):
+        """
+        Gets the next frame as dense screens, like touchscreenSimulator.get_frame
+        """
+        position = self.get_position(actual_position)
+        if position is None:
+            return None
+        if actual_position:
+            return tuple(self.convert_coordinate_to_screen(*p) for p in position)
+        return self.convert_coordinate_to_screen(*position)
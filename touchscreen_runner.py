@@ -1,9 +1,10 @@
 import argparse
 import json
 
-import numpy as np
-
+import batch_evaluation
+import instrumentation
 from touchscreen import touchscreenHMM
+from touchscreen_helpers import simulation_io
 from touchscreen_helpers.simulation_evaluator import touchscreenEvaluator
 from touchscreen_helpers.simulator import touchscreenSimulator
 
@@ -28,6 +29,35 @@ if __name__ == "__main__":
     )
     parser.add_argument("--save_file", type=str, help="save the simulation to a file")
     parser.add_argument("--load_file", type=str, help="load the simulation from a file")
+    parser.add_argument(
+        "--load_glob",
+        type=str,
+        help="evaluate every saved simulation in a directory or matching a glob, in parallel",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="with --load_glob, the number of worker processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--report", type=str, help="with --load_glob, also write the report to a JSON file"
+    )
+    parser.add_argument(
+        "--save_format",
+        choices=["binary", "text"],
+        default="binary",
+        help="the format --save_file is written in (--load_file reads either)",
+    )
+    parser.add_argument(
+        "--smooth",
+        action="store_true",
+        help="with --evaluate, score forward-backward smoothed posteriors over the whole simulation",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="with --evaluate, print call counts and timings of the HMM and evaluator stages",
+    )
     parser.add_argument(
         "--frame_length",
         type=float,
@@ -39,6 +69,18 @@ if __name__ == "__main__":
     save_file = args.save_file
     load_file = args.load_file
 
+    if args.load_glob:
+        if save_file or load_file or args.visualize or args.smooth:
+            parser.error("--load_glob can't be combined with --save_file, --load_file, --visualize or --smooth")
+        print(f"Evaluating saved simulations in {args.load_glob}.")
+        report = batch_evaluation.evaluate_corpus(args.load_glob, args.workers)
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=4, sort_keys=True)
+        report.pop("per_file", None)
+        print(f"Report: {json.dumps(report, indent=4, sort_keys=True)}")
+        parser.exit()
+
     if save_file and load_file:
         parser.error("both --save_file and --load_file were given")
     elif load_file and not args.visualize and not args.evaluate:
@@ -46,41 +88,49 @@ if __name__ == "__main__":
             "nothing to do for loaded simulation: --visualize and --evaluate were false"
         )
 
-    simulator = touchscreenSimulator(args.width, args.height, args.frames)
-
     if load_file:
         print(f"Loading saved simulation from {load_file}.")
-        with open(load_file, "r") as f:
-            first_line = [int(x) for x in f.readline().strip().split(" ")]
-            width, height, frames = first_line
-            data = np.loadtxt(f, dtype="int", skiprows=0)
-        simulator.load_simulation(data)
+        width, height, data = simulation_io.load_simulation(load_file)
+        if args.visualize:
+            # Only the compiled simulator visualizes, and it holds every frame as a
+            # dense screen, so the coordinates are otherwise replayed directly
+            simulator = touchscreenSimulator(width, height, args.frames)
+            simulator.load_simulation(data)
     else:
+        width, height = args.width, args.height
+        simulator = touchscreenSimulator(width, height, args.frames)
         print("Running simulation.")
         simulator.run_simulation()
 
     if save_file:
         print(f"Saving simulation to {save_file}.")
-        with open(save_file, "w") as f:
-            f.write(
-                "%d %d %d\n" % (simulator.width, simulator.height, simulator.frames)
-            )
-            for (noisy, actual) in iter(
-                lambda: simulator.get_frame(actual_position=True), None
-            ):
-                noisy_loc = np.asarray(np.where(noisy == 1)).T.tolist()[0]
-                actual_loc = np.asarray(np.where(actual == 1)).T.tolist()[0]
-                to_print = noisy_loc + actual_loc
-                np.savetxt(f, to_print, fmt="%i", newline=" ")
-                f.write("\n")
-        simulator.timestamp = 0
+        simulation_io.save_simulation(
+            save_file,
+            simulator.width,
+            simulator.height,
+            simulation_io.simulation_positions(simulator),
+            binary=args.save_format == "binary",
+        )
 
     if args.evaluate:
-        student_hmm = touchscreenHMM(args.width, args.height)
+        if args.profile:
+            instrumentation.enable(allocations=True)
+        student_hmm = touchscreenHMM(width, height)
         if args.visualize:
             simulator.visualize_results(student_hmm, args.frame_length)
         evaluator = touchscreenEvaluator()
-        score = evaluator.evaluate_touchscreen_hmm(student_hmm, simulator)
+        if args.smooth:
+            positions = data if load_file else simulation_io.simulation_positions(simulator)
+            posteriors = student_hmm.smooth_sequence(positions[:, :2])
+            score = evaluator.score_run(positions[:, :2], positions[:, 2:], posteriors)
+        elif load_file and not args.visualize:
+            # Replay the loaded coordinates directly instead of as dense frames
+            simulation = simulation_io.touchscreenReplay(width, height, data)
+            score = evaluator.evaluate_touchscreen_hmm(student_hmm, simulation)
+        else:
+            score = evaluator.evaluate_touchscreen_hmm(student_hmm, simulator)
         print(f"Score: {json.dumps(score, indent=4, sort_keys=True)}")
+        if args.profile:
+            print(f"Profile: {json.dumps(instrumentation.stats(), indent=4, sort_keys=True)}")
     elif args.visualize:
         simulator.visualize_simulation(args.frame_length)
@@ -1,10 +1,29 @@
+import asyncio
+import os
+import tempfile
 import unittest
+import weakref
+from unittest import mock
 
 import numpy as np
 
+import batch_evaluation
+import instrumentation
+import touchscreen
+from baum_welch import baum_welch
+from emission_cache import EmissionCache
 from hmm import HMM
-from hmm_runner import suppliedModel
-from touchscreen import touchscreenHMM
+from hmm_runner import simpleModel, suppliedModel
+from motion_kernel import MotionKernel
+from particle_filter import touchscreenParticleFilter
+from touch_server import SessionPool, TouchServer
+from smoothing import FixedLagSmoother, forward_backward
+from touchscreen import touchscreenBatchHMM, touchscreenHMM, touchscreenVelocityHMM
+from touchscreen_helpers import model_store, simulation_evaluator, simulation_io
+from touchscreen_helpers.batch_simulator import touchscreenBatchSimulator
+from touchscreen_helpers.model_estimation import MAX_CELL_STEP, count_simulation, parallel_counts, touchscreenCounts
+from touchscreen_helpers.simulation_evaluator import touchscreenEvaluator
+from touchscreen_helpers.simulator import touchscreenSimulator
 
 
 class IOTest(unittest.TestCase):
@@ -34,6 +53,56 @@ class IOTest(unittest.TestCase):
             "HMM did not produce a probability distribution for timestep 4",
         )
 
+    def _check_long_horizon(self, model):
+        supplied_model = suppliedModel()
+        model_instance = model(
+            sensor_model=supplied_model.sensor_model,
+            transition_model=supplied_model.transition_model,
+            num_states=supplied_model.num_states,
+        )
+        model_instance.tell("A")
+        model_instance.tell("C")
+        stepped = model_instance.ask(2)
+        for horizon in range(1, 40):
+            stepped = stepped @ model_instance.transition_matrix
+            stepped /= np.sum(stepped)
+            self.assertTrue(
+                np.allclose(model_instance.ask(2 + horizon), stepped),
+                f"HMM prediction differs from stepping {horizon} timesteps ahead",
+            )
+        self.assertTrue(
+            self._is_close(np.sum(model_instance.ask(10 ** 9)), 1),
+            "HMM did not produce a probability distribution for a very long horizon",
+        )
+
+    def _check_viterbi(self, model):
+        simple_model = simpleModel()
+        model_instance = model(
+            sensor_model=simple_model.sensor_model,
+            transition_model=simple_model.transition_model,
+            num_states=simple_model.num_states,
+        )
+        observations = list("ABCCBACBBACCAB")
+        path = model_instance.viterbi().decode(observations)
+        self.assertEqual(len(path), len(observations))
+        # State 3 can never produce a 'C'
+        self.assertTrue(all(state != 3 for state, obs in zip(path, observations) if obs == "C"))
+
+        decoder = model_instance.viterbi()
+        online_path = []
+        for observation in observations:
+            online_path += decoder.push(observation)
+        online_path += decoder.flush()
+        self.assertEqual(online_path, path, "Online Viterbi differs from decoding the whole sequence")
+
+        bounded_decoder = model_instance.viterbi(max_lag=2)
+        bounded_path = []
+        for observation in observations:
+            bounded_path += bounded_decoder.push(observation)
+            self.assertLessEqual(len(bounded_decoder.backpointers), 2)
+        bounded_path += bounded_decoder.flush()
+        self.assertEqual(len(bounded_path), len(observations))
+
     def _check_filtered_frame(self, model):
         sample_frame = np.zeros((20, 20))
         sample_frame[0][0] = 1.0
@@ -44,12 +113,562 @@ class IOTest(unittest.TestCase):
             "Filtered frame is not a probability distribution",
         )
 
+    def _check_filtered_batch(self, model):
+        sample_frames = np.zeros((3, 20, 20))
+        sample_frames[0][0][0] = 1.0
+        sample_frames[1][5][7] = 1.0
+        sample_frames[2][19][19] = 1.0
+        batch_instance = touchscreenBatchHMM(model(), 3)
+        filtered_frames = batch_instance.filter_noisy_data(sample_frames)
+        self.assertEqual(filtered_frames.shape, (3, 20, 20))
+        for filtered_frame in filtered_frames:
+            self.assertTrue(
+                self._is_close(np.sum(filtered_frame), 1),
+                "Batched filtered frame is not a probability distribution",
+            )
+
+        # Every row filters like a model of its own, also when only some streams are told
+        single_instances = [model() for _ in range(3)]
+        for single_instance, sample_frame, filtered_frame in zip(single_instances, sample_frames, filtered_frames):
+            self.assertTrue(np.allclose(filtered_frame, single_instance.filter_noisy_data(sample_frame)))
+        for positions, streams in [
+            ([(0, 1), (5, 6), (19, 18)], None),
+            ([(1, 1), (18, 18)], [0, 2]),
+            ([(4, 6)], [1]),
+        ]:
+            told = batch_instance.tell(np.array(positions), streams)
+            for row, stream, position in zip(told, streams or range(3), positions):
+                expected = single_instances[stream].filter_noisy_data(position)
+                self.assertTrue(np.allclose(row, expected.ravel()), f"Stream {stream} differs from a single model")
+        for stream, single_instance in enumerate(single_instances):
+            self.assertTrue(np.allclose(batch_instance.probabilities[stream], single_instance.hmm.probabilities))
+
+    def _check_beam(self, model):
+        exact_instance = model()
+        beam_instance = model()
+        beam_instance.use_beam(threshold=1e-15)
+        for position in [(0, 0), (0, 1), (1, 1), (2, 2)]:
+            exact_frame = exact_instance.filter_noisy_data(position)
+            beam_frame = beam_instance.filter_noisy_data(position)
+            self.assertTrue(np.allclose(exact_frame, beam_frame, atol=1e-9), "Beam filtering drifted from exact filtering")
+        self.assertLess(beam_instance.hmm.total_pruned_mass, 1e-9)
+
+        # With a sensor that only reads next to the finger, the jump to the far
+        # corner loses track, and both restart from the sensor model
+        local = MotionKernel(np.ones((3, 3)) / 9, 10, 10).matrix().tocsc()
+        exact_hmm = touchscreen.HMM.from_tables(np.ones(100), local, local, 10, 10)
+        beam_hmm = touchscreen.HMM.from_tables(np.ones(100), local, local, 10, 10)
+        beam_hmm.use_beam(top_k=20)
+        for position in [(0, 0), (1, 1), (9, 9), (8, 9)]:
+            self.assertTrue(np.allclose(exact_hmm.tell(position), beam_hmm.tell(position), atol=1e-9))
+
+    def _check_lost_track(self):
+        # One row follows the prediction, one lost track and restarts from the
+        # sensor model, and one saw an observation nothing explains
+        predicted = np.array([[0.5, 0.5, 0.0], [1.0, 0.0, 0.0], [0.0, 0.25, 0.75]])
+        likelihoods = np.array([[0.2, 0.6, 0.0], [0.0, 0.3, 0.1], [0.0, 0.0, 0.0]])
+        out = np.empty((3, 3))
+        filtered, scales = touchscreen.HMM.update(predicted, likelihoods, out=out)
+        self.assertIs(filtered, out)
+        self.assertTrue(np.allclose(filtered, [[0.25, 0.75, 0], [0, 0.75, 0.25], [0, 0.25, 0.75]]))
+        self.assertTrue(np.allclose(scales, [0.4, 0, 0]))
+        for row in range(3):
+            single, scale = touchscreen.HMM.update(predicted[row], likelihoods[row])
+            self.assertTrue(np.allclose(single, filtered[row]) and np.isclose(scale, scales[row]))
+
+        # Normalized as one distribution, restarting with the rows weighted
+        restart_weights = np.array([[0.25], [0.75]])
+        filtered, scale = touchscreen.HMM.update(
+            np.tile(predicted[1], (2, 1)) / 2, likelihoods[1], restart_weights=restart_weights, axis=None
+        )
+        self.assertEqual(scale, 0)
+        self.assertTrue(np.allclose(filtered, restart_weights * likelihoods[1] / 0.4))
+
+    def _check_velocity_filter(self):
+        model = touchscreenHMM()
+        velocity_instance = touchscreenVelocityHMM(model)
+        steps = 2 * MAX_CELL_STEP + 1
+        # moves[v] @ p moves a distribution over cells by velocity v, stopping at the edges
+        moves = np.zeros((steps ** 2, model.num_states, model.num_states))
+        for v in range(steps ** 2):
+            dx, dy = v // steps - MAX_CELL_STEP, v % steps - MAX_CELL_STEP
+            for x in range(model.width):
+                for y in range(model.height):
+                    nx = min(max(x + dx, 0), model.width - 1)
+                    ny = min(max(y + dy, 0), model.height - 1)
+                    moves[v, nx * model.height + ny, x * model.height + y] = 1
+        joint = np.outer(model.velocity_prior, model.hmm.prior)
+        for observation in self._touch_sequence(8).tolist():
+            accelerated = np.asarray(model.velocity_table).T @ joint
+            joint = np.stack([moves[v] @ accelerated[v] for v in range(steps ** 2)])
+            joint *= model.hmm.compute_emission(tuple(observation))
+            joint /= np.sum(joint)
+            self.assertTrue(
+                np.allclose(velocity_instance.tell(tuple(observation)), np.sum(joint, axis=0)),
+                "The velocity filter differs from enumerating every position and velocity",
+            )
+
+    def _check_particle_filter(self):
+        motion = np.array([[1.0, 2, 1], [2, 4, 2], [1, 2, 1]]) / 16
+        noise = np.array([[0.0, 1, 0], [1, 6, 1], [0, 1, 0]]) / 10
+        particle_instance = touchscreenParticleFilter(10, 10, motion, noise, 0.0, num_particles=200000, seed=0)
+        # The dense grid filter the particles approximate
+        transition = MotionKernel(motion, 10, 10, fft=False).matrix().toarray()
+        exact = None
+        for x, y in [(4, 4), (4, 5), (5, 5), (5, 6), (6, 6)]:
+            likelihoods = np.zeros((10, 10))
+            likelihoods[x - 1:x + 2, y - 1:y + 2] = noise[::-1, ::-1]
+            exact = likelihoods.ravel() if exact is None else (transition.T @ exact) * likelihoods.ravel()
+            exact /= np.sum(exact)
+            filtered_frame = particle_instance.filter_noisy_data((x, y))
+            self.assertLess(
+                np.sum(np.abs(filtered_frame.ravel() - exact)), 0.03, "The particles drifted from the grid filter"
+            )
+
+    def _check_emission_cache(self):
+        computed = []
+        cache = EmissionCache(lambda observation: computed.append(observation) or np.ones(2), capacity=2)
+        for observation in ["A", "B", "A", "C", "B", "A"]:
+            cache.lookup(observation)
+        self.assertEqual(computed, ["A", "B", "C", "B", "A"])
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (1, 5, 3))
+        self.assertEqual(list(cache.vectors), ["B", "A"], "Evicted observations were kept")
+
+    def _check_motion_kernel(self, fft):
+        kernel = np.arange(1.0, 26.0).reshape(5, 5)
+        motion = MotionKernel(kernel / np.sum(kernel), 7, 6, fft)
+        transition = motion.matrix().toarray()
+        self.assertTrue(np.allclose(np.sum(transition, axis=1), 1), "Edge rows are not renormalized")
+        probabilities = np.linspace(1, 2, 42) / np.sum(np.linspace(1, 2, 42))
+        self.assertTrue(
+            np.allclose(motion.predict(probabilities), transition.T @ probabilities),
+            "Convolution does not match the equivalent transition table",
+        )
+
+    def _check_batch_evaluation(self):
+        simulator = touchscreenSimulator(20, 20, 50)
+        simulator.run_simulation()
+        positions = simulation_io.simulation_positions(simulator)
+        with tempfile.TemporaryDirectory() as directory:
+            simulation_io.save_simulation(os.path.join(directory, "run.sim"), 20, 20, positions)
+            with open(os.path.join(directory, "broken.sim"), "w") as f:
+                f.write("not a simulation\n")
+            report = batch_evaluation.evaluate_corpus(directory, workers=1)
+        self.assertEqual((report["files"], len(report["failed"]), report["frames"]), (1, 1, 50))
+        expected = touchscreenEvaluator().evaluate_touchscreen_hmm(
+            touchscreenHMM(), simulation_io.touchscreenReplay(20, 20, positions)
+        )
+        self.assertEqual(report["score"], expected, "Corpus score differs from evaluating the file alone")
+
+        # A file with no noise has no rubric of its own, and touches off the
+        # screen fail only their own file
+        clean = np.array([[1, 1, 1, 1], [2, 2, 2, 2], [3, 3, 3, 3]])
+        off_screen = np.array([[1, 1, 1, 1], [25, 3, 2, 2]])
+        with tempfile.TemporaryDirectory() as directory:
+            simulation_io.save_simulation(os.path.join(directory, "clean.sim"), 20, 20, clean)
+            simulation_io.save_simulation(os.path.join(directory, "off_screen.sim"), 20, 20, off_screen)
+            report = batch_evaluation.evaluate_corpus(directory, workers=1)
+        self.assertEqual((report["files"], len(report["failed"])), (1, 1))
+        self.assertIsNone(report["per_file"][0]["score"])
+        self.assertIsNone(report["score"])
+
+    def _check_vectorized_scoring(self):
+        simulator = touchscreenBatchSimulator(frames=300, seed=2)
+        simulator.run_simulation()
+        model = touchscreenHMM()
+
+        class framesOnly:
+            # Hides get_position, so the evaluator takes its original frame-by-frame loop
+            def __init__(self, replay):
+                self.get_frame = replay.get_frame
+
+        model.hmm.reset()
+        dense = touchscreenEvaluator().evaluate_touchscreen_hmm(model, framesOnly(simulator.replay()))
+        model.hmm.reset()
+        with mock.patch.object(simulation_evaluator, "SCORE_CHUNK_BYTES", 64 * 20 * 20 * 8):
+            chunked = touchscreenEvaluator().evaluate_touchscreen_hmm(model, simulator.replay())
+        model.hmm.reset()
+        positions = simulator.positions[0]
+        student_frames = np.array([model.filter_noisy_data(tuple(position)) for position in positions[:, :2].tolist()])
+        run = touchscreenEvaluator().score_run(positions[:, :2], positions[:, 2:], student_frames)
+        self.assertEqual(chunked, dense, "Chunked replay scoring differs from the frame-by-frame loop")
+        self.assertEqual(run, dense, "score_run differs from the frame-by-frame loop")
+
+    def _check_baum_welch(self, workers):
+        simulator = touchscreenBatchSimulator(frames=100, batch=4, seed=3)
+        simulator.run_simulation()
+        sequences = [np.array(positions[:, :2]) for positions in simulator.positions]
+        history = baum_welch(touchscreenHMM(), sequences, iterations=4, workers=workers, tolerance=-np.inf)
+        self.assertEqual(len(history), 4)
+        self.assertTrue(
+            np.all(np.diff(history) >= -1e-9 * np.abs(history[:-1])), f"The log-likelihood decreased: {history}"
+        )
+
+        # The re-estimated prior is the posterior of the state before the first touch
+        sequences = [self._touch_sequence(frames) for frames in (30, 31, 32)]
+        model = touchscreenHMM()
+        expected = sum(self._naive_initial_posterior(model, sequence) for sequence in sequences)
+        baum_welch(model, sequences, iterations=1, workers=workers)
+        self.assertTrue(np.allclose(model.prior, expected / np.sum(expected)), "The prior is not the EM update")
+
+    def _naive_initial_posterior(self, model, observations):
+        transition = model.hmm.predict_matrix.T.toarray()
+        beta = np.ones(model.num_states)
+        for observation in observations.tolist()[::-1]:
+            beta = transition @ (model.hmm.compute_emission(tuple(observation)) * beta)
+            beta = beta / np.sum(beta)
+        posterior = model.hmm.prior * beta
+        return posterior / np.sum(posterior)
+
+    def _touch_sequence(self, frames):
+        # The finger's own path: every touch is one the trained model can explain
+        simulator = touchscreenSimulator(20, 20, frames)
+        simulator.run_simulation()
+        return np.array(simulation_io.simulation_positions(simulator)[:, 2:], dtype=int)
+
+    def _naive_forward_backward(self, model, observations):
+        transition = model.hmm.predict_matrix.T.toarray()
+        emissions = [model.hmm.compute_emission(tuple(observation)) for observation in observations.tolist()]
+        alphas, alpha = [], np.asarray(model.hmm.prior, dtype=float)
+        for likelihoods in emissions:
+            alpha = (alpha @ transition) * likelihoods
+            alpha = alpha / np.sum(alpha)
+            alphas.append(alpha)
+        posteriors, beta = [None] * len(emissions), np.ones(len(alpha))
+        for t in range(len(emissions) - 1, -1, -1):
+            posteriors[t] = alphas[t] * beta / np.sum(alphas[t] * beta)
+            beta = transition @ (emissions[t] * beta)
+            beta = beta / np.sum(beta)
+        return np.array(posteriors)
+
+    def _check_forward_backward(self):
+        model = touchscreenHMM()
+        observations = self._touch_sequence(12)
+        naive = self._naive_forward_backward(model, observations)
+        single = forward_backward(model, observations, segment_length=len(observations))
+        segmented = forward_backward(model, observations, segment_length=2)
+        self.assertTrue(np.allclose(segmented, single), "Checkpointed segments change the posteriors")
+        self.assertTrue(np.allclose(single, naive), "forward_backward differs from a dense forward-backward")
+
+    def _check_fixed_lag(self, lag):
+        model = touchscreenHMM()
+        observations = self._touch_sequence(10)
+        smoother = FixedLagSmoother(model, lag)
+        for frames, observation in enumerate(observations.tolist(), start=1):
+            smoothed = smoother.tell(tuple(observation))
+            if frames <= lag:
+                self.assertIsNone(smoothed, f"tell returned a distribution after {frames} frames at lag {lag}")
+                continue
+            expected = forward_backward(model, observations[:frames])[frames - 1 - lag]
+            self.assertTrue(np.allclose(smoothed, expected), f"Lag {lag} smoothing differs after {frames} frames")
+
+    async def _run_touch_server(self):
+        server = TouchServer(SessionPool(touchscreenHMM(), max_sessions=2, idle_timeout=60))
+        listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection(*listener.sockets[0].getsockname()[:2])
+
+        async def send(line):
+            writer.write(line.encode() + b"\n")
+            await writer.drain()
+            return (await reader.readline()).decode().split()
+
+        try:
+            reply = await send("phone 3 4")
+            self.assertEqual(reply[0], "phone")
+            self.assertTrue(0 < float(reply[3]) <= 1)
+            self.assertEqual((await send("phone a b"))[0], "ERROR")
+            self.assertEqual((await send("phone 3 4"))[0], "phone", "A malformed line closed the connection")
+
+            writer.write(b"RESET phone\n")
+            self.assertEqual((await send("tablet 1 1"))[0], "tablet")
+            self.assertNotIn("phone", server.pool.streams)
+            # Only two sessions fit, so a third device evicts the least recently seen
+            await send("watch 2 2")
+            await send("laptop 5 5")
+            self.assertEqual(set(server.pool.streams), {"watch", "laptop"})
+            self.assertEqual(server.pool.evict_idle(float("inf")), 2)
+
+            # Frames sent together are filtered as if each device had a model of its own,
+            # even when a new device needs a session while the pool is full
+            frames = [("a", 1, 1), ("b", 2, 2), ("a", 1, 2), ("c", 3, 3)]
+            references = {device: touchscreenHMM() for device in "abc"}
+            writer.write("".join(f"{device} {x} {y}\n" for device, x, y in frames).encode())
+            replies = {device: [] for device in "abc"}
+            for _ in frames:
+                reply = (await reader.readline()).decode().split()
+                replies[reply[0]].append(reply)
+            for device, x, y in frames:
+                expected = references[device].filter_noisy_data((x, y))
+                reply = replies[device].pop(0)
+                self.assertEqual(
+                    (int(reply[1]), int(reply[2])),
+                    np.unravel_index(np.argmax(expected), expected.shape),
+                    f"Device {device} was filtered from the wrong belief",
+                )
+                self.assertTrue(np.isclose(float(reply[3]), np.max(expected), rtol=1e-5))
+
+            # A reset waits for the frames sent before it
+            writer.write(b"d 4 4\nRESET d\nd 4 4\n")
+            first = (await reader.readline()).decode().split()
+            self.assertEqual((await reader.readline()).decode().split(), first, "The reset was applied out of order")
+        finally:
+            writer.close()
+            await writer.wait_closed()
+            # Let the server see the disconnect before the loop shuts down
+            await asyncio.sleep(0.01)
+            listener.close()
+            await listener.wait_closed()
+
+    def _check_shared_tables(self):
+        publisher = touchscreenHMM()
+        shared = publisher.publish_models()
+        try:
+            attached = touchscreenHMM.attach(shared.name)
+            tables = attached.shared_tables
+            self.assertFalse(tables.arrays["prior"].flags.writeable, "Attached tables are writable")
+            with self.assertRaises(ValueError):
+                tables.arrays["prior"][0] = 1
+            for position in [(0, 0), (0, 1), (1, 1), (2, 2)]:
+                self.assertTrue(
+                    np.array_equal(attached.filter_noisy_data(position), publisher.filter_noisy_data(position)),
+                    "The attached model filters differently from the publisher",
+                )
+            view = weakref.ref(attached.transition_table.data)
+            attached.close()
+            self.assertIsNone(view(), "The model kept a view into the detached tables")
+            self.assertIsNone(attached.shared_tables)
+        finally:
+            shared.close()
+        with self.assertRaises(FileNotFoundError):
+            model_store.SharedTables.attach(shared.name)
+
+    def _check_saved_simulation(self):
+        positions = np.array([[0, 1, 0, 0], [2, 3, 1, 2], [4, 0, 3, 1]], dtype=int)
+        with tempfile.TemporaryDirectory() as directory:
+            for binary in (True, False):
+                for frames in (positions, positions[:0]):
+                    path = os.path.join(directory, f"run_{binary}_{len(frames)}.sim")
+                    simulation_io.save_simulation(path, 5, 4, frames, binary=binary)
+                    self.assertEqual(simulation_io.is_binary_simulation(path), binary)
+                    self.assertEqual(simulation_io.read_simulation_header(path), (5, 4, len(frames)))
+                    width, height, loaded = simulation_io.load_simulation(path)
+                    self.assertEqual((width, height), (5, 4))
+                    self.assertEqual(loaded.shape, (len(frames), 4))
+                    self.assertTrue(np.array_equal(loaded, frames), f"{path} changed on the round trip")
+
+            replay = simulation_io.touchscreenReplay.from_file(os.path.join(directory, "run_True_3.sim"))
+            noisy, actual = replay.get_frame(actual_position=True)
+            self.assertEqual(noisy.shape, (5, 4))
+            self.assertEqual((np.argmax(noisy), np.argmax(actual)), (0 * 4 + 1, 0))
+
+    def _check_saved_tables(self):
+        arrays = {
+            "floats": np.linspace(0, 1, 7),
+            "ints": np.arange(12, dtype=np.int32).reshape(3, 4),
+            "empty": np.zeros(0),
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "model.tables")
+            model_store.save_tables(path, arrays, {"width": 3})
+            loaded, metadata = model_store.load_tables(path)
+            self.assertEqual(metadata, {"width": 3})
+            self.assertEqual(set(loaded), set(arrays))
+            for name, array in arrays.items():
+                self.assertEqual(loaded[name].dtype, array.dtype)
+                self.assertTrue(np.array_equal(loaded[name], array), f"{name} changed on the round trip")
+
+            with open(path, "r+b") as f:
+                f.seek(len(model_store.MAGIC))
+                f.write(np.array([model_store.FORMAT_VERSION + 1], dtype="<u4").tobytes())
+            self.assertIsNone(model_store.load_tables(path), "A different format version was loaded")
+            with open(path, "r+b") as f:
+                f.write(b"NOTMAGIC")
+            self.assertIsNone(model_store.load_tables(path), "A file with the wrong magic bytes was loaded")
+            self.assertIsNone(model_store.load_tables(os.path.join(directory, "missing.tables")))
+
+    def _check_instrumentation(self):
+        methods = {(cls, name): cls.__dict__.get(name) for cls, names in instrumentation.STAGES.values() for name in names}
+        instrumentation.reset()
+        instrumentation.enable()
+        try:
+            self.assertTrue(instrumentation.enabled())
+            self.assertIsNot(HMM.__dict__["tell"], methods[(HMM, "tell")], "tell was not instrumented")
+            simple_model = simpleModel()
+            model_instance = HMM(simple_model.sensor_model, simple_model.transition_model, simple_model.num_states)
+            for observation in "ABCAB":
+                model_instance.tell(observation)
+        finally:
+            instrumentation.disable()
+        for (cls, name), method in methods.items():
+            self.assertIs(cls.__dict__.get(name), method, f"disable() did not restore {cls.__name__}.{name}")
+        tell = instrumentation.stats()["hmm.HMM.tell"]
+        self.assertEqual(tell["calls"], 5)
+        self.assertTrue(0 <= tell["p50_us"] <= tell["p90_us"] <= tell["p99_us"])
+        self.assertEqual(instrumentation.stats()["hmm.HMM.__init__"]["calls"], 1)
+
+        # A nested stage's peak counts towards the peak of the stage around it
+        megabyte = 1 << 20
+        inner = instrumentation.timed("test.inner", lambda: len(bytearray(8 * megabyte)))
+
+        def run_outer():
+            held = bytearray(megabyte)
+            inner()
+            return len(held)
+
+        def run_outer_first():
+            # The peak before the nested call must survive it resetting the peak
+            len(bytearray(16 * megabyte))
+            return inner()
+
+        outer = instrumentation.timed("test.outer", run_outer)
+        outer_first = instrumentation.timed("test.outer_first", run_outer_first)
+        instrumentation.enable(allocations=True)
+        try:
+            outer()
+            outer_first()
+        finally:
+            instrumentation.disable()
+            stats = instrumentation.stats()
+            for name in ("test.inner", "test.outer", "test.outer_first"):
+                instrumentation.stages.pop(name)
+        self.assertTrue(8 * megabyte <= stats["test.inner"]["peak_bytes"] < 8.5 * megabyte)
+        self.assertTrue(9 * megabyte <= stats["test.outer"]["peak_bytes"] < 9.5 * megabyte)
+        self.assertTrue(16 * megabyte <= stats["test.outer_first"]["peak_bytes"] < 16.5 * megabyte)
+        self.assertLess(stats["test.outer"]["allocated_bytes_per_call"], megabyte / 2)
+
+    def _assert_same_counts(self, counts, expected):
+        self.assertTrue(np.array_equal(counts.occupancy, expected.occupancy), "Occupancy counts differ")
+        self.assertEqual((counts.transitions != expected.transitions).nnz, 0, "Transition counts differ")
+        self.assertEqual((counts.sensor != expected.sensor).nnz, 0, "Sensor counts differ")
+        self.assertTrue(np.array_equal(counts.velocities, expected.velocities), "Velocity counts differ")
+
+    def _check_chunked_counts(self):
+        rng = np.random.default_rng(3)
+        actual = np.cumsum(rng.integers(-1, 2, size=(500, 2)), axis=0) % (6, 5)
+        actual = actual[:, 0] * 5 + actual[:, 1]
+        noisy = np.where(rng.random(500) < 0.7, actual, rng.integers(30, size=500))
+
+        whole = touchscreenCounts(6, 5)
+        whole.add(noisy, actual)
+        for chunk in (1, 7, 64, 499):
+            chunked = touchscreenCounts(6, 5)
+            for start in range(0, len(actual), chunk):
+                chunked.add(noisy[start:start + chunk], actual[start:start + chunk])
+            self._assert_same_counts(chunked, whole)
+
+        # One trajectory counted as a batch matches counting it in one go
+        batch = touchscreenCounts(6, 5)
+        batch.add_batch(noisy[None], actual[None])
+        self._assert_same_counts(batch, whole)
+
+    def _check_parallel_counts(self, workers):
+        merged = parallel_counts(9, 7, 1001, workers, seed=11, simulator="numpy")
+        serial = touchscreenCounts(9, 7)
+        seeds = np.random.SeedSequence(11).generate_state(workers)
+        for i, seed in enumerate(seeds):
+            share = 1001 // workers + (i < 1001 % workers)
+            serial.merge(count_simulation(9, 7, share, int(seed), simulator="numpy"))
+        self.assertEqual(np.sum(merged.occupancy), 1001)
+        self._assert_same_counts(merged, serial)
+
+    def _check_batch_simulator(self):
+        simulators = [touchscreenBatchSimulator(20, 15, 200, batch=4, seed=1) for _ in range(2)]
+        for simulator in simulators:
+            simulator.run_simulation()
+        positions = simulators[0].positions
+        self.assertEqual(positions.shape, (4, 200, 4))
+        self.assertTrue(np.array_equal(positions, simulators[1].positions), "Seeded simulations differ")
+        self.assertTrue(np.all(positions >= 0) and np.all(positions[:, :, ::2] < 20) and np.all(positions[:, :, 1::2] < 15))
+        self.assertLessEqual(np.max(np.abs(np.diff(positions[:, :, 2:], axis=1))), 1, "The finger moved too far")
+        # Calibrated to the compiled simulator, where about 32% of readings land on the finger
+        on_finger = np.mean(np.all(positions[:, :, :2] == positions[:, :, 2:], axis=2))
+        self.assertAlmostEqual(on_finger, 0.32, delta=0.06)
+        simulator = touchscreenBatchSimulator(seed=1)
+        simulator.run_simulation()
+        replay = simulator.replay()
+        touchscreenEvaluator().evaluate_touchscreen_hmm(touchscreenHMM(), replay)
+        self.assertEqual(replay.timestamp, simulator.frames, "The evaluator did not play every simulated frame")
+
     def test_hmm(self):
         self._check_distribution(HMM)
 
+    def test_hmm_viterbi(self):
+        self._check_viterbi(HMM)
+
+    def test_hmm_emission_cache(self):
+        self._check_emission_cache()
+
+    def test_hmm_long_horizon(self):
+        self._check_long_horizon(HMM)
+
     def test_touchscreen(self):
         self._check_filtered_frame(touchscreenHMM)
 
+    def test_touchscreen_beam(self):
+        self._check_beam(touchscreenHMM)
+
+    def test_touchscreen_lost_track(self):
+        self._check_lost_track()
+
+    def test_touchscreen_velocity(self):
+        self._check_filtered_frame(lambda: touchscreenVelocityHMM(touchscreenHMM()))
+        self._check_velocity_filter()
+
+    def test_touchscreen_particles(self):
+        self._check_filtered_frame(lambda: touchscreenParticleFilter.from_model(touchscreenHMM(), 20, 20, seed=0))
+        self._check_particle_filter()
+
+    def test_batch_evaluation(self):
+        self._check_batch_evaluation()
+
+    def test_vectorized_scoring(self):
+        self._check_vectorized_scoring()
+
+    def test_baum_welch(self):
+        self._check_baum_welch(workers=1)
+
+    def test_baum_welch_shared_tables(self):
+        self._check_baum_welch(workers=2)
+
+    def test_forward_backward(self):
+        self._check_forward_backward()
+
+    def test_fixed_lag(self):
+        self._check_fixed_lag(lag=0)
+        self._check_fixed_lag(lag=3)
+
+    def test_touch_server(self):
+        asyncio.run(self._run_touch_server())
+
+    def test_shared_tables(self):
+        self._check_shared_tables()
+
+    def test_saved_simulation(self):
+        self._check_saved_simulation()
+
+    def test_saved_tables(self):
+        self._check_saved_tables()
+
+    def test_instrumentation(self):
+        self._check_instrumentation()
+
+    def test_chunked_counts(self):
+        self._check_chunked_counts()
+
+    def test_parallel_counts(self):
+        self._check_parallel_counts(workers=3)
+
+    def test_batch_simulator(self):
+        self._check_batch_simulator()
+
+    def test_touchscreen_batch(self):
+        self._check_filtered_batch(touchscreenHMM)
+
+    def test_motion_kernel(self):
+        self._check_motion_kernel(fft=False)
+        self._check_motion_kernel(fft=True)
+
 
 if __name__ == "__main__":
     unittest.main()
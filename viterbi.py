@@ -0,0 +1,192 @@
+from collections import deque
+from typing import Callable, Hashable, Iterable, List, Optional
+
+import numpy as np
+from scipy import sparse
+
+from emission_cache import EMISSION_CACHE_SIZE, EmissionCache
+
+
+class Viterbi:
+    """
+    Finds the most likely sequence of hidden states for a sequence of
+    observations, working in log space so long sequences cannot underflow.
+
+    Each step is a vectorized max-product over the non-zero transitions into
+    every state, so the sparse touchscreen model costs O(non-zeros) per frame.
+    Observations can be pushed one at a time: once every surviving path agrees
+    on a prefix, that prefix is decided and returned, and its backpointers are
+    dropped. With max_lag set, the oldest undecided state is also forced (from
+    the currently best path) whenever more than max_lag states are pending,
+    which bounds memory at max_lag backpointer arrays however long the stream.
+
+    Like HMM.tell, every observation follows one transition from the previous
+    state, and the initial distribution describes the state before the first
+    observation; decoded paths start at the state of the first observation.
+    """
+
+    def __init__(
+        self,
+        transition,
+        emission: Callable[[Hashable], np.ndarray],
+        initial: np.ndarray,
+        max_lag: Optional[int] = None,
+        cache_size: int = EMISSION_CACHE_SIZE,
+    ):
+        """
+        Inputs:
+        - transition: transition[s][s'] = P(s' | s), a dense or sparse (N x N) matrix
+        - emission:   Maps an observation to the array of P(observation | s) over every state
+        - initial:    The distribution of the state before the first observation
+        - max_lag:    The most states left undecided before the oldest is forced,
+                      or None to only decide states every surviving path agrees on
+        - cache_size: The most log-likelihood vectors kept, see EmissionCache
+        """
+        transition = sparse.csc_matrix(transition, dtype=float)
+        self.num_states = transition.shape[0]
+        self.emission = emission
+        self.max_lag = max_lag
+        self.log_emissions = EmissionCache(self.compute_log_emission, cache_size)
+
+        # Column s' of a CSC matrix lists every predecessor of s' contiguously, so
+        # the best predecessor of each state is one reduceat over the non-zeros.
+        self.predecessors = transition.indices
+        with np.errstate(divide="ignore"):
+            self.log_transitions = np.log(transition.data)
+        counts = np.diff(transition.indptr)
+        self.has_predecessors = counts > 0
+        self.starts = transition.indptr[:-1][self.has_predecessors]
+        self.segments = np.repeat(np.arange(self.num_states), counts)
+        self.positions = np.arange(len(self.predecessors))
+
+        with np.errstate(divide="ignore"):
+            self.initial_log = np.log(np.asarray(initial, dtype=float))
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets every observation, going back to the initial distribution.
+        """
+        self.delta = self.initial_log.copy()
+        self.time = 0
+        # The earliest undecided time. Time 0 is the initial state, which is never reported.
+        self.first = 1
+        # backpointers[k] maps each state at time first + 1 + k to its best predecessor
+        self.backpointers = deque()
+
+    def compute_log_emission(self, observation) -> np.ndarray:
+        with np.errstate(divide="ignore"):
+            return np.log(self.emission(observation))
+
+    def log_emission(self, observation) -> np.ndarray:
+        return self.log_emissions.lookup(observation)
+
+    def best_predecessors(self):
+        """
+        Returns the best log score of reaching each state at the next step, and
+        the predecessor that achieves it.
+        """
+        scores = self.delta[self.predecessors] + self.log_transitions
+        best = np.full(self.num_states, -np.inf)
+        backpointer = np.zeros(self.num_states, dtype=np.int64)
+        if len(scores):
+            best[self.has_predecessors] = np.maximum.reduceat(scores, self.starts)
+            # The first position in each column that reaches its maximum
+            winners = np.where(scores == best[self.segments], self.positions, len(scores))
+            backpointer[self.has_predecessors] = self.predecessors[np.minimum.reduceat(winners, self.starts)]
+        return best, backpointer
+
+    def push(self, observation) -> List[int]:
+        """
+        Adds the next observation.
+
+        Input:
+        - observation: The observation at the next timestep
+
+        Output:
+        - The states that have just been decided, in time order, continuing the
+          states returned by earlier calls
+        """
+        log_likelihoods = self.log_emission(observation)
+        best, backpointer = self.best_predecessors()
+        delta = best + log_likelihoods
+        if not np.any(np.isfinite(delta)):
+            if np.any(np.isfinite(log_likelihoods)):
+                # No reachable state can produce the observation, so the track is
+                # lost: restart from the observation, after the best state so far.
+                delta = log_likelihoods.copy()
+                backpointer[:] = np.argmax(self.delta)
+            else:
+                # Nothing is known about this observation; keep the prediction.
+                delta = best
+        self.delta = delta - np.max(delta)
+        self.time += 1
+        if self.time > self.first:
+            self.backpointers.append(backpointer)
+
+        decided = self.decide_converged()
+        if self.max_lag is not None and self.time - self.first >= self.max_lag:
+            decided += self.decide(self.time - self.max_lag, int(np.argmax(self.delta)))
+        return decided
+
+    def trace(self, until: int, state: int) -> List[int]:
+        """
+        Follows backpointers from state at the current time back to the earliest
+        undecided time, and returns the states from then until time `until`.
+        """
+        path = [state]
+        for backpointer in reversed(self.backpointers):
+            path.append(int(backpointer[path[-1]]))
+        path.reverse()
+        return path[: until - self.first + 1]
+
+    def decide(self, until: int, state: int) -> List[int]:
+        """
+        Decides every undecided state up to time `until` along the path ending at
+        `state` now, and drops the backpointers that are no longer needed.
+        """
+        if until < self.first:
+            return []
+        decided = self.trace(until, state)
+        for _ in range(min(until + 1 - self.first, len(self.backpointers))):
+            self.backpointers.popleft()
+        self.first = until + 1
+        return decided
+
+    def decide_converged(self) -> List[int]:
+        """
+        Walks the surviving states back in time until they all share one
+        ancestor, and decides everything up to that ancestor.
+        """
+        survivors = np.flatnonzero(np.isfinite(self.delta))
+        time = self.time
+        merged = np.zeros(self.num_states, dtype=bool)
+        for backpointer in reversed(self.backpointers):
+            if len(survivors) == 1:
+                break
+            merged[:] = False
+            merged[backpointer[survivors]] = True
+            survivors = np.flatnonzero(merged)
+            time -= 1
+        if len(survivors) != 1:
+            return []
+        # Follow the current best path, which passes through the shared ancestor
+        return self.decide(time, int(np.argmax(self.delta)))
+
+    def flush(self) -> List[int]:
+        """
+        Decides every remaining state along the currently most likely path.
+        """
+        return self.decide(self.time, int(np.argmax(self.delta)))
+
+    def decode(self, observations: Iterable) -> List[int]:
+        """
+        Returns the most likely state for every observation in a sequence,
+        starting from the initial distribution.
+        """
+        self.reset()
+        path = []
+        for observation in observations:
+            path += self.push(observation)
+        path += self.flush()
+        return path